@@ -4,9 +4,19 @@
 Author: Ian Davis
 """
 
+import glob
+import logging
+import marshal
+import os
+import re
+import threading
+
 import os_util
 
 from ConfigParser import ConfigParser
+from ConfigParser import Error as ConfigParserError
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 
 class InvalidSectionError(Exception):
@@ -25,20 +35,101 @@ class InvalidOptionError(Exception):
     pass
 
 
+_BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
+                   '0': False, 'no': False, 'false': False, 'off': False}
+
+# Bumped whenever the layout of the sidecar cache file changes, so stale caches are ignored.
+_CACHE_FORMAT = 1
+
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+_DURATION_PATTERN = re.compile(r'\s*(\d+(?:\.\d*)?)\s*(ms|s|m|h|d)?\s*', re.IGNORECASE)
+
+
+def to_boolean(value):
+    """ Convert an option value to a boolean, accepting the same strings as ConfigParser.getboolean.
+
+        :param value: The option value to convert.
+        :raise ValueError: If the value is not a recognized boolean string.
+        :return: The converted boolean.
+    """
+    if isinstance(value, bool):
+        return value
+
+    try:
+        return _BOOLEAN_STATES[str(value).strip().lower()]
+    except KeyError:
+        raise ValueError('Not a boolean: {0}'.format(value))
+
+
+def to_list(value, separator=','):
+    """ Convert an option value to a sequence by splitting it on separator, stripping whitespace from each item.
+
+        :note: A tuple is returned so the cached value can be safely shared between callers.
+
+        :param value: The option value to convert.
+        :param separator: The string that separates items in the value.
+        :return: The converted tuple of items.
+    """
+    if not isinstance(value, basestring):
+        return tuple(value)
+
+    return tuple(item.strip() for item in value.split(separator) if item.strip())
+
+
+def to_duration(value):
+    """ Convert an option value to a number of seconds, values can be plain numbers of seconds,
+        or a sequence of numbers with units (ms, s, m, h, d), such as '1h30m' or '500ms'.
+
+        :param value: The option value to convert.
+        :raise ValueError: If the value is not a valid duration.
+        :return: The duration, in seconds, as a float.
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+
+    value = value.strip()
+    total = 0.0
+    position = 0
+
+    while position < len(value):
+        match = _DURATION_PATTERN.match(value, position)
+
+        if not match or not match.group(0):
+            raise ValueError('Not a duration: {0}'.format(value))
+
+        amount, unit = match.groups()
+        total += float(amount) * _DURATION_UNITS[(unit or 's').lower()]
+        position = match.end()
+
+    if not value:
+        raise ValueError('Not a duration: {0}'.format(value))
+
+    return total
+
+
 class ConfigurationSection(object):
     """ ConfigurationSection handles the data stored in one
         section of a configuration file.
     """
 
-    def __init__(self, name, options=None):
+    def __init__(self, name, options=None, schema=None):
         """ ConfigurationSection constructor.
 
             :param name: Name of the section
             :param options: Optional parameter that should be a dictionary of option_name: option_value
                  for this configuration section.
+            :param schema: Optional dictionary of option_name: converter (such as int, float or to_boolean),
+                 options in the schema are converted once when loaded instead of on every access.
         """
         self.name = name
         self.options = options
+        self.schema = schema or {}
+        self.dirty = True
+        self.owner = None
+        self._converted = {}
+
+        if self.options:
+            self._convert_schema_options()
 
     def _verify_section_exists(self, config_parser):
         """ Private method used by the write method to assert
@@ -65,29 +156,175 @@ class ConfigurationSection(object):
             
             :param config_parser: The ConfigParser instance to read from.
         """
-        self.options = {}
+        options = {}
 
         for option_name, option_value in config_parser.items(self.name):
-            self.options[option_name] = option_value
+            options[option_name] = option_value
+
+        self.options = options
+        self.dirty = False
+        self._converted = {}
+        self._convert_schema_options()
+
+    def _convert_schema_options(self):
+        """ Convert every option declared in our schema up front, so later typed reads are cache hits.
+        """
+        for option_name, converter in self.schema.iteritems():
+            if option_name in self.options:
+                self.get_typed(option_name, converter)
+
+    def get_typed(self, key, converter):
+        """ Return the value of an option converted by the given callable,
+            the converted value is cached until the option is set again or the section is re-read.
+
+            :param key: The name of the option.
+            :param converter: A callable that converts the raw option value.
+            :return: The converted option value.
+        """
+        conversions = self._converted.get(key)
+
+        if conversions is not None and converter in conversions:
+            return conversions[converter]
+
+        value = converter(self[key])
+        self._converted.setdefault(key, {})[converter] = value
+        return value
+
+    def get(self, key):
+        """ Return the value of an option, converted if our schema declares a type for it.
+
+            :param key: The name of the option.
+        """
+        converter = self.schema.get(key)
+
+        if converter is None:
+            return self[key]
+
+        return self.get_typed(key, converter)
+
+    def get_int(self, key):
+        """ Return the value of an option as an integer.
+
+            :param key: The name of the option.
+        """
+        return self.get_typed(key, int)
+
+    def get_float(self, key):
+        """ Return the value of an option as a float.
+
+            :param key: The name of the option.
+        """
+        return self.get_typed(key, float)
+
+    def get_bool(self, key):
+        """ Return the value of an option as a boolean (1/0, yes/no, true/false, on/off).
+
+            :param key: The name of the option.
+        """
+        return self.get_typed(key, to_boolean)
+
+    def get_list(self, key):
+        """ Return the value of an option as a tuple of comma separated items.
+
+            :param key: The name of the option.
+        """
+        return self.get_typed(key, to_list)
+
+    def get_duration(self, key):
+        """ Return the value of an option as a number of seconds, see to_duration.
+
+            :param key: The name of the option.
+        """
+        return self.get_typed(key, to_duration)
 
     def __getitem__(self, key):
         """ Python builtin handler for dictionary notation access
             ConfigurationSection[key] == ConfigurationSection.__getitem__(key)
         """
-        if key in self.options:
+        try:
             return self.options[key]
+        except KeyError:
+            raise InvalidOptionError(key)
 
-        raise InvalidOptionError(key)
+    def _set_option(self, key, value):
+        """ Set the value of an existing option, converting it first if our schema declares a type for it.
+        """
+        self._converted.pop(key, None)
+
+        if key in self.schema:
+            converter = self.schema[key]
+            self._converted[key] = {converter: converter(value)}
+
+        self.options[key] = value
+        self.dirty = True
 
     def __setitem__(self, key, value):
         """ Python builtin handler for dictionary notation access
             (ConfigurationSection[key] = value) == ConfigurationSection.__setitem__(key, value)
+
+            If the section belongs to a Configuration, the change is serialized through its lock.
         """
-        if key in self.options:
-            self.options[key] = value
+        if key not in self.options:
+            raise InvalidOptionError(key)
+
+        if self.owner is None:
+            self._set_option(key, value)
             return
 
-        raise InvalidOptionError(key)
+        with self.owner.lock:
+            self._set_option(key, value)
+            self.owner._mark_changed(self.name)
+
+
+class ConfigurationSnapshot(object):
+    """ ConfigurationSnapshot is an immutable, versioned view of the
+        sections and options of a Configuration at one point in time,
+        returned by Configuration.snapshot.
+
+        The option dictionaries are shared between snapshots and must not be modified.
+    """
+
+    def __init__(self, version, sections):
+        """ ConfigurationSnapshot constructor.
+
+            :param version: The Configuration version this snapshot was taken at.
+            :param sections: A dictionary of section_name: {option_name: option_value}.
+        """
+        self.version = version
+        self._sections = sections
+
+    def sections(self):
+        """ Return the names of all sections in the snapshot.
+        """
+        return self._sections.keys()
+
+    def get(self, section_name, option_name):
+        """ Return the value of one option in the snapshot.
+
+            :param section_name: The name of the section.
+            :param option_name: The name of the option.
+            :raise InvalidSectionError: If the section does not exist.
+            :raise InvalidOptionError: If the option does not exist.
+        """
+        try:
+            return self[section_name][option_name]
+        except KeyError:
+            raise InvalidOptionError(option_name)
+
+    def __contains__(self, key):
+        return key in self._sections
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __getitem__(self, key):
+        """ Python builtin handler for dictionary notation access
+            ConfigurationSnapshot[key] == ConfigurationSnapshot.__getitem__(key)
+        """
+        try:
+            return self._sections[key]
+        except KeyError:
+            raise InvalidSectionError(key)
 
 
 class Configuration(object):
@@ -95,18 +332,39 @@ class Configuration(object):
         ConfigParser class, built to handle an app level
         configuration file, and reading and writing values
         to said file.
+
+        Every method that modifies the configuration is serialized through
+        Configuration.lock, so a control thread can update values while others read them.
+        Threads that need a consistent view of many options at once should use snapshot,
+        which returns an immutable copy without taking the lock unless the configuration changed.
     """
 
-    def __init__(self, file_path, sections=None, default_sections=None):
+    def __init__(self, file_path, sections=None, default_sections=None, schema=None, cache_path=None):
         """ Configuration initalizer.
         
             :param file_path: The path to the config file to read/write.
             :param sections: A list of any initial ConfigSections to add.
             :param default_sections: A dictionary of the initial section-key-values to add.
+            :param schema: A dictionary of section-option-converters, in the same layout as default_sections,
+                 declaring the types of options so they are converted once when loaded (see ConfigurationSection.get).
+            :param cache_path: Optional path of a sidecar file to cache the parsed sections in,
+                 when the cache matches the configuration file it is loaded instead of parsing the file.
         """
         self.file_path = file_path
         self.sections = {}
         self.default_sections = default_sections
+        self.schema = schema or {}
+        self.cache_path = cache_path
+        self.lock = threading.RLock()
+        self.version = 0
+        self._batch_depth = 0
+        self._parser_stale = False
+        self._signature = None
+        self._change_callbacks = []
+        self._watcher = None
+        self._stop_watching = threading.Event()
+        self._changed_sections = None
+        self._snapshot = ConfigurationSnapshot(version=-1, sections={})
 
         self.config_parser = ConfigParser()
 
@@ -114,7 +372,7 @@ class Configuration(object):
             if not self.sections:
                 self._setup_default_sections()
 
-            self.write()
+            self.write(force=True)
 
         if not self.sections:
             self.read()
@@ -128,24 +386,22 @@ class Configuration(object):
         self._verify_section_integrity()
 
     def _verify_section_integrity(self):
-        """ Verify that all sections and their default options exist in the configuration file. """
-        needs_rewrite = False
-
-        for section_name, options in self.default_sections.iteritems():
-            if section_name not in self.sections:
-                self.add_section(name=section_name, options=options)
-                needs_rewrite = True
-                continue
-
-            section = self.sections[section_name]
+        """ Verify that all sections and their default options exist in the configuration file,
+            the missing ones are written in a single batch.
+        """
+        with self.batch():
+            for section_name, options in self.default_sections.iteritems():
+                if section_name not in self.sections:
+                    self.add_section(name=section_name, options=options)
+                    continue
 
-            for option_name, option_value in options.iteritems():
-                if option_name not in section.options:
-                    needs_rewrite = True
-                    section.options[option_name] = option_value
+                section = self.sections[section_name]
 
-        if needs_rewrite:
-            self.write()
+                for option_name, option_value in options.iteritems():
+                    if option_name not in section.options:
+                        section.options[option_name] = option_value
+                        section.dirty = True
+                        self._mark_changed(section_name)
 
     def _setup_default_sections(self):
         """ Setup all default sections and their values for a first init.
@@ -155,6 +411,27 @@ class Configuration(object):
         """
         pass
 
+    def _adopt(self, section):
+        """ Take ownership of a ConfigurationSection, so changes made to it directly
+            are serialized through our lock and show up in our snapshots.
+
+            :param section: The ConfigurationSection to own.
+            :return: The same ConfigurationSection.
+        """
+        section.owner = self
+        return section
+
+    def _mark_changed(self, *section_names):
+        """ Bump our version after a change to the given sections, must be called while holding our lock.
+            When called with no section names, every section is considered changed.
+        """
+        if not section_names:
+            self._changed_sections = None
+        elif self._changed_sections is not None:
+            self._changed_sections.update(section_names)
+
+        self.version += 1
+
     def add_sections(self, sections):
         """ Interface method to add multiple sections to our configuration
             file at once, call this to ensure that the sections are added
@@ -162,11 +439,16 @@ class Configuration(object):
             
             :param sections: A list of ConfigurationSections to add.
         """
-        for section_name, section in sections.items():
-            self.sections[section_name] = section
+        with self.lock:
+            self._load_parser()
 
-            self.config_parser.add_section(section_name)
-            section.write(config_parser=self.config_parser)
+            for section_name, section in sections.items():
+                self.sections[section_name] = self._adopt(section)
+
+                self.config_parser.add_section(section_name)
+                section.write(config_parser=self.config_parser)
+
+            self._mark_changed(*sections.keys())
 
     def add_section(self, name, options=None):
         """ Interface method to add a section to our configuration
@@ -176,25 +458,121 @@ class Configuration(object):
             :param name: The name of the section to add.
             :param options: Any options to add to the section.
         """
-        section = ConfigurationSection(name=name, options=options)
-        self.sections[name] = section
+        with self.lock:
+            self._load_parser()
+
+            section = ConfigurationSection(name=name, options=options, schema=self.schema.get(name))
+            self.sections[name] = self._adopt(section)
+            self._mark_changed(name)
+
+            self.config_parser.add_section(name)
+            section.write(config_parser=self.config_parser)
+
+            self.write()
+
+    @property
+    def dirty(self):
+        """ Whether or not any section has changes that have not been written to file yet.
+        """
+        return any(section.dirty for section in self.sections.values())
+
+    @contextmanager
+    def batch(self):
+        """ Context manager to group many changes into a single write,
+            any call to write while inside the batch is deferred until the
+            outermost batch exits, at which point all dirty sections are flushed at once.
+            Our lock is held for the whole batch, so other threads never see it half applied.
+
+            with configuration.batch():
+                for name, options in generated_sections.iteritems():
+                    configuration.add_section(name=name, options=options)
+        """
+        with self.lock:
+            self._batch_depth += 1
+
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+
+            if not self._batch_depth:
+                self.write()
+
+    def snapshot(self):
+        """ Return an immutable, versioned ConfigurationSnapshot of all sections and options.
+
+            While the configuration is unchanged this is a lock-free attribute load of the last snapshot,
+            after a change the first caller rebuilds it, copying only the sections that changed.
+
+            :return: The current ConfigurationSnapshot.
+        """
+        snapshot = self._snapshot
 
-        self.config_parser.add_section(name)
-        section.write(config_parser=self.config_parser)
+        if snapshot.version == self.version:
+            return snapshot
+
+        with self.lock:
+            if self._snapshot.version != self.version:
+                self._snapshot = self._build_snapshot()
+
+            return self._snapshot
+
+    def _build_snapshot(self):
+        """ Build a new ConfigurationSnapshot from the last one and the sections changed since,
+            must be called while holding our lock.
+        """
+        changed_sections, self._changed_sections = self._changed_sections, set()
 
-        self.write()
+        if changed_sections is None:
+            sections = dict((section_name, dict(section.options or {}))
+                            for section_name, section in self.sections.iteritems())
+            return ConfigurationSnapshot(version=self.version, sections=sections)
 
-    def write(self):
+        sections = dict(self._snapshot._sections)
+
+        for section_name in changed_sections:
+            section = self.sections.get(section_name)
+
+            if section is None:
+                sections.pop(section_name, None)
+            else:
+                sections[section_name] = dict(section.options or {})
+
+        return ConfigurationSnapshot(version=self.version, sections=sections)
+
+    def write(self, force=False):
         """ Could be considered a private method, this is called by
             the constructor if the configuration file doesn't exist,
-            but could also be called by outside code to force a rewrite
-            of the configuration file.
+            but could also be called by outside code to flush any changes
+            to the configuration file.
+
+            Only sections that have changed are re-serialized, and the file
+            is left untouched if nothing changed, unless force is given.
+            The file is replaced atomically, so it is never left half-written.
+
+            :param force: Rewrite the file even if no sections have changed.
         """
-        for section in self.sections.itervalues():
-            section.write(self.config_parser)
+        with self.lock:
+            if self._batch_depth:
+                return
+
+            dirty_sections = [section for section in self.sections.itervalues() if section.dirty]
 
-        with open(self.file_path, 'wb') as config_file:
-            self.config_parser.write(config_file)
+            if not dirty_sections and not force:
+                return
+
+            self._load_parser()
+
+            for section in dirty_sections:
+                section.write(self.config_parser)
+
+            with os_util.atomic_write(self.file_path, 'wb') as config_file:
+                self.config_parser.write(config_file)
+
+            for section in dirty_sections:
+                section.dirty = False
+
+            self._signature = self._file_signature()
 
     def read(self):
         """ Could be considered a private method, this is called by
@@ -206,31 +584,400 @@ class Configuration(object):
         if not os_util.is_file(self.file_path):
             return
 
-        self.sections = {}
-        self.config_parser.read(self.file_path)
+        with self.lock:
+            sections = {}
+            self._signature = self._file_signature()
+
+            cached_sections = self._read_cache()
+
+            if cached_sections is not None:
+                for section_name, options in cached_sections.iteritems():
+                    section = ConfigurationSection(name=section_name, options=options,
+                                                   schema=self.schema.get(section_name))
+                    section.dirty = False
+
+                    sections[section_name] = self._adopt(section)
+
+                # The file itself is only parsed if we need to write back to it.
+                self._parser_stale = True
+            else:
+                self.config_parser.read(self.file_path)
+                self._parser_stale = False
+
+                for section_name in self.config_parser.sections():
+                    section = ConfigurationSection(name=section_name, schema=self.schema.get(section_name))
+                    section.read_options(config_parser=self.config_parser)
+
+                    sections[section_name] = self._adopt(section)
+
+            # Swap the new sections in all at once, so readers never see them half built.
+            self.sections = sections
+            self._mark_changed()
+
+            if cached_sections is None:
+                self._write_cache()
+
+    def _load_parser(self):
+        """ Parse the configuration file into our ConfigParser if the sections were loaded from the cache,
+            so writes see the full contents of the file.
+        """
+        if self._parser_stale:
+            self.config_parser.read(self.file_path)
+            self._parser_stale = False
+
+    def _cache_key(self):
+        """ Return the key identifying the configuration file the cache was built from,
+            the file's hash is stored and checked separately so it is only computed when this key matches.
+        """
+        return (_CACHE_FORMAT, os.path.abspath(self.file_path)) + self._signature
+
+    def _read_cache(self):
+        """ Load the sections from our sidecar cache file.
+
+            :return: A dictionary of section-option-values, or None if there is no valid cache for the file.
+        """
+        if not self.cache_path or not self._signature or not os_util.is_file(self.cache_path):
+            return None
+
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                cache_key, file_hash, sections = marshal.load(cache_file)
+        except (EOFError, ValueError, TypeError, IOError, OSError):
+            return None
+
+        if cache_key != self._cache_key() or file_hash != os_util.md5(self.file_path):
+            return None
+
+        return sections
+
+    def _write_cache(self):
+        """ Store the sections as they were just parsed from file in our sidecar cache file.
+        """
+        if not self.cache_path or not self._signature:
+            return
+
+        sections = dict((section_name, section.options) for section_name, section in self.sections.iteritems())
+
+        try:
+            with os_util.atomic_write(self.cache_path, 'wb') as cache_file:
+                marshal.dump((self._cache_key(), os_util.md5(self.file_path), sections), cache_file)
+        except (IOError, OSError):
+            # The cache is only an optimization, carry on without it if it cannot be written.
+            pass
+
+    def _file_signature(self):
+        """ Return a cheap fingerprint (modification time and size) of the configuration file,
+            used to detect changes without parsing it, or None if the file does not exist.
+        """
+        try:
+            file_stat = os.stat(self.file_path)
+        except OSError:
+            return None
+
+        return file_stat.st_mtime, file_stat.st_size
+
+    def add_change_callback(self, callback, section_name=None):
+        """ Register a callable to be invoked for every section that changes when the file is reloaded.
+
+            The callback is called as callback(section_name, old_section, new_section),
+            where old_section is None for an added section and new_section is None for a removed one.
+
+            :param callback: The callable to invoke.
+            :param section_name: Only invoke the callback for changes to this section, default: all sections.
+        """
+        self._change_callbacks.append((section_name, callback))
+
+    def reload(self):
+        """ Re-read the configuration file if it has changed on disk since it was last read or written.
+            Only the ConfigurationSections whose options differ are swapped in, unchanged
+            sections keep their existing instances, and change callbacks are fired for each changed section.
+
+            :return: A list of the names of the sections that changed.
+        """
+        with self.lock:
+            signature = self._file_signature()
+
+            if signature is None or signature == self._signature:
+                return []
+
+            config_parser = ConfigParser()
+            config_parser.read(self.file_path)
+
+            sections = dict(self.sections)
+            changes = []
+
+            for section_name in config_parser.sections():
+                section = ConfigurationSection(name=section_name, schema=self.schema.get(section_name))
+                section.read_options(config_parser=config_parser)
+                old_section = sections.get(section_name)
+
+                if old_section is not None and old_section.options == section.options:
+                    continue
+
+                sections[section_name] = self._adopt(section)
+                changes.append((section_name, old_section, section))
 
-        for section_name in self.config_parser.sections():
-            section = ConfigurationSection(name=section_name)
-            section.read_options(config_parser=self.config_parser)
+            for section_name in set(sections).difference(config_parser.sections()):
+                changes.append((section_name, sections.pop(section_name), None))
 
-            self.sections[section_name] = section
+            self.sections = sections
+            self.config_parser = config_parser
+            self._parser_stale = False
+            self._signature = signature
+
+            if changes:
+                self._mark_changed(*[section_name for section_name, old_section, new_section in changes])
+
+        for section_name, old_section, new_section in changes:
+            for callback_section_name, callback in self._change_callbacks:
+                if callback_section_name is None or callback_section_name == section_name:
+                    callback(section_name, old_section, new_section)
+
+        return [section_name for section_name, old_section, new_section in changes]
+
+    def watch(self, interval=1.0):
+        """ Start a background thread that checks the configuration file every interval seconds,
+            and reloads it when it has changed. Only a stat is done per check, the file is parsed
+            only when its modification time or size changes.
+
+            :param interval: The time, in seconds, between checks.
+        """
+        if self._watcher and self._watcher.is_alive():
+            return
+
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,))
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop_watching(self):
+        """ Stop the background thread started by watch, if it is running.
+        """
+        self._stop_watching.set()
+
+        if self._watcher:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval):
+        """ Target of the watcher thread, reload the file every interval seconds until stopped.
+        """
+        while not self._stop_watching.wait(interval):
+            try:
+                self.reload()
+            except ConfigParserError:
+                # The file is most likely being written by someone else, try again on the next check.
+                continue
+            except ValueError:
+                # An option does not match its schema, keep the sections we have until the file is fixed.
+                logging.getLogger(__name__).exception('Failed to reload {0}'.format(self.file_path))
 
     def __getitem__(self, key):
         """ Python builtin handler for dictionary notation access
             Configuration[key] == Configuration.__getitem__(key)
         """
-        if key in self.sections:
+        try:
             return self.sections[key]
-
-        raise InvalidSectionError(key)
+        except KeyError:
+            raise InvalidSectionError(key)
 
     def __setitem__(self, key, value):
         """ Python builtin handler for dictionary notation access
             (Configuration[key] = value) ==
                 Configuration.__setitem__(key, value)
         """
-        if key in self.sections:
-            self.sections[key] = value
-            return
+        with self.lock:
+            if key in self.sections:
+                value.dirty = True
+                self.sections[key] = self._adopt(value)
+                self._mark_changed(key)
+                return
 
         raise InvalidSectionError(key)
+
+
+class LayeredConfiguration(object):
+    """ LayeredConfiguration merges several configuration sources into one
+        read-only view, in increasing order of precedence:
+        default_sections, the base configuration file, every fragment file
+        in a conf.d style directory (in file name order), and environment
+        variables named {environment_prefix}{SECTION}__{OPTION}.
+
+        The merged view is precomputed as a ConfigurationSnapshot, so lookups are
+        plain dictionary accesses, and when a layer changes only the sections it touched are merged again.
+    """
+
+    # Fragment directories with at least this many files are parsed on a thread pool.
+    PARALLEL_THRESHOLD = 16
+
+    def __init__(self, file_path, fragment_directory=None, fragment_pattern='*.conf', environment_prefix=None,
+                 default_sections=None, max_workers=8):
+        """ LayeredConfiguration initializer.
+
+            :param file_path: The path to the base config file.
+            :param fragment_directory: Optional path to a directory of override fragments.
+            :param fragment_pattern: The glob pattern fragment file names must match.
+            :param environment_prefix: Optional prefix of environment variables to take overrides from,
+                 section and option names are lower cased, ex: APP_MAIN__PORT sets option port of section main.
+            :param default_sections: A dictionary of the lowest precedence section-key-values.
+            :param max_workers: The maximum number of threads used to parse fragments in parallel.
+        """
+        self.file_path = file_path
+        self.fragment_directory = fragment_directory
+        self.fragment_pattern = fragment_pattern
+        self.environment_prefix = environment_prefix
+        self.default_sections = default_sections or {}
+        self.max_workers = max_workers
+        self.lock = threading.RLock()
+        self.version = 0
+
+        self.base = Configuration(file_path)
+        self.fragments = {}
+        self._environment = self._environment_sections()
+        self._view = ConfigurationSnapshot(version=self.version, sections={})
+
+        fragment_paths = self._fragment_paths()
+        self.fragments = dict(zip(fragment_paths, self._load_fragments(fragment_paths)))
+
+        self._merge()
+
+    def _fragment_paths(self):
+        """ Return the sorted paths of all fragment files in our fragment directory.
+        """
+        if not self.fragment_directory or not os_util.is_directory(self.fragment_directory):
+            return []
+
+        return sorted(path for path in glob.glob(os.path.join(self.fragment_directory, self.fragment_pattern))
+                      if os_util.is_file(path))
+
+    def _load_fragments(self, paths):
+        """ Parse the given fragment files, on a thread pool if there are many of them.
+
+            :param paths: The paths of the fragments to parse.
+            :return: A list of Configurations, in the same order as paths.
+        """
+        if len(paths) < self.PARALLEL_THRESHOLD:
+            return [Configuration(path) for path in paths]
+
+        pool = ThreadPool(min(self.max_workers, len(paths)))
+
+        try:
+            return pool.map(Configuration, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _environment_sections(self):
+        """ Collect the section-key-values overridden through environment variables.
+        """
+        sections = {}
+
+        if not self.environment_prefix:
+            return sections
+
+        for name, value in os.environ.iteritems():
+            if not name.startswith(self.environment_prefix):
+                continue
+
+            section_name, separator, option_name = name[len(self.environment_prefix):].partition('__')
+
+            if not section_name or not option_name:
+                continue
+
+            sections.setdefault(section_name.lower(), {})[option_name.lower()] = value
+
+        return sections
+
+    def _layers(self):
+        """ Return the section-key-values of every layer, from lowest to highest precedence.
+        """
+        layers = [self.default_sections, self.base.snapshot()]
+        layers.extend(self.fragments[path].snapshot() for path in sorted(self.fragments))
+        layers.append(self._environment)
+        return layers
+
+    def _merge(self, section_names=None):
+        """ Merge the given sections of every layer into a new view, reusing the current view for all other sections.
+
+            :param section_names: The names of the sections to merge again, default: all sections.
+        """
+        with self.lock:
+            layers = self._layers()
+
+            if section_names is None:
+                sections = {}
+                section_names = set().union(*layers)
+            else:
+                sections = dict(self._view._sections)
+
+            for section_name in section_names:
+                options = None
+
+                for layer in layers:
+                    if section_name in layer:
+                        options = options or {}
+                        options.update(layer[section_name])
+
+                if options is None:
+                    sections.pop(section_name, None)
+                else:
+                    sections[section_name] = options
+
+            self.version += 1
+            self._view = ConfigurationSnapshot(version=self.version, sections=sections)
+
+    def reload(self):
+        """ Check every layer for changes, including fragments added to or removed from the fragment directory,
+            and merge again only the sections that changed in any of them.
+
+            :return: A list of the names of the sections that changed.
+        """
+        with self.lock:
+            changed_sections = set(self.base.reload())
+            fragment_paths = self._fragment_paths()
+
+            for path in set(self.fragments).difference(fragment_paths):
+                changed_sections.update(self.fragments.pop(path).sections)
+
+            for path, fragment in self.fragments.iteritems():
+                changed_sections.update(fragment.reload())
+
+            new_paths = [path for path in fragment_paths if path not in self.fragments]
+
+            for path, fragment in zip(new_paths, self._load_fragments(new_paths)):
+                self.fragments[path] = fragment
+                changed_sections.update(fragment.sections)
+
+            environment = self._environment_sections()
+
+            for section_name in set(environment).union(self._environment):
+                if environment.get(section_name) != self._environment.get(section_name):
+                    changed_sections.add(section_name)
+
+            self._environment = environment
+
+            if changed_sections:
+                self._merge(changed_sections)
+
+            return list(changed_sections)
+
+    def snapshot(self):
+        """ Return the current merged view of all layers, as an immutable ConfigurationSnapshot.
+        """
+        return self._view
+
+    def get(self, section_name, option_name):
+        """ Return the merged value of one option.
+
+            :param section_name: The name of the section.
+            :param option_name: The name of the option.
+            :raise InvalidSectionError: If no layer has the section.
+            :raise InvalidOptionError: If no layer has the option.
+        """
+        return self._view.get(section_name, option_name)
+
+    def __getitem__(self, key):
+        """ Python builtin handler for dictionary notation access
+            LayeredConfiguration[key] == LayeredConfiguration.__getitem__(key)
+        """
+        return self._view[key]
@@ -4,23 +4,183 @@
 Author: Ian Davis
 """
 
+import array
+import cPickle
+import functools
+import heapq
 import itertools
+import multiprocessing
+import numbers
+import tempfile
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    numpy = None
+
+from collections import deque
+
+# Inputs smaller than this are processed in-process by parallel_map and parallel_filter,
+# since starting a process pool would cost more than it saves.
+PARALLEL_MINIMUM_ITEMS = 1000
+
+# The default number of elements external_sort holds in memory before spilling a sorted run to disk.
+EXTERNAL_RUN_SIZE = 100000
+
+# The number of elements pickled together when writing a run, to amortize the cost of each pickle call.
+_RUN_BLOCK_SIZE = 1000
+
+
+def _is_numpy_array(iterable):
+    """ Return whether the given iterable is a NumPy array that qualifies for a vectorized implementation,
+        that is NumPy is importable and the array holds a homogeneous (non-object) dtype.
+
+        :param iterable: The iterable to check.
+    """
+    return numpy is not None and isinstance(iterable, numpy.ndarray) and iterable.dtype != object
 
 
 def filter_by_type(list_, filter_type):
     """ Filter the given list down to a list of the given types.
 
+        :note: One dimensional NumPy arrays are selected by dtype and filtered into a NumPy array,
+            arrays (from the array module) are selected by typecode.
+
         :param list_: The unfiltered list.
         :param filter_type: The type of element to filter down too.
         :return: The filtered list, with only elements of the given type.
     """
-    filtered_list = []
+    if _is_numpy_array(list_) and list_.ndim == 1:
+        if list_.dtype.type is filter_type:
+            return list_.copy()
+
+        return list_[:0].copy()
+
+    # Arrays hold a single type of element, except 'L' which holds both ints and longs depending on their size.
+    if isinstance(list_, array.array) and list_.typecode != 'L':
+        if list_ and type(list_[0]) is filter_type:
+            return list(list_)
 
-    for item in list_:
+        return []
+
+    return list(ifilter_by_type(list_, filter_type))
+
+
+def ifilter_by_type(iterable, filter_type):
+    """ Lazily filter the given iterable down to the elements of the given type.
+
+        :param iterable: The unfiltered iterable.
+        :param filter_type: The type of element to filter down too.
+        :return: Generator that yields only elements of the given type.
+    """
+    for item in iterable:
         if type(item) is filter_type:
-            filtered_list.append(item)
+            yield item
+
+
+class MultiPatternMatcher(object):
+    """ Aho-Corasick automaton that tests whether a string contains any of a set of substrings,
+        scanning each string once no matter how many patterns there are.
+
+        Build it once from the filter values and reuse it for every item to filter.
+
+        :param patterns: The substrings to search for.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        self.match_all = '' in self.patterns
+        self._transitions, self._terminal = self._compile(self.patterns)
 
-    return filtered_list
+    @staticmethod
+    def _compile(patterns):
+        """ Build the automaton for the given patterns, with the failure links folded into the transitions
+            so that scanning takes exactly one dictionary lookup per character.
+
+            :param patterns: The substrings to search for.
+            :return: A list of per-state transition dictionaries, and a list of whether each state completes a pattern.
+        """
+        goto = [{}]
+        terminal = [False]
+
+        for pattern in patterns:
+            state = 0
+
+            for character in pattern:
+                next_state = goto[state].get(character)
+
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][character] = next_state
+                    goto.append({})
+                    terminal.append(False)
+
+                state = next_state
+
+            terminal[state] = True
+
+        transitions = [None] * len(goto)
+        transitions[0] = goto[0]
+        failure = [0] * len(goto)
+        queue = deque(goto[0].itervalues())
+
+        while queue:
+            state = queue.popleft()
+            fallback_state = failure[state]
+            terminal[state] = terminal[state] or terminal[fallback_state]
+
+            state_transitions = dict(transitions[fallback_state])
+            state_transitions.update(goto[state])
+            transitions[state] = state_transitions
+
+            for character, next_state in goto[state].iteritems():
+                failure[next_state] = transitions[fallback_state].get(character, 0) if state else 0
+                queue.append(next_state)
+
+        return transitions, terminal
+
+    def matches(self, value):
+        """ Return whether the given value contains any of our patterns.
+
+            :note: Objects that are not strings are compared by their string form.
+
+            :param value: The value to search.
+        """
+        if self.match_all:
+            return True
+
+        transitions = self._transitions
+        terminal = self._terminal
+        state = 0
+
+        for character in value if isinstance(value, basestring) else str(value):
+            state = transitions[state].get(character, 0)
+
+            if terminal[state]:
+                return True
+
+        return False
+
+    def ifilter(self, iterable):
+        """ Lazily filter the given iterable down to the items that contain any of our patterns.
+
+            :param iterable: The iterable to filter.
+            :return: Generator that yields each matching item once, in its original form.
+        """
+        matches = self.matches
+
+        for value in iterable:
+            if matches(value):
+                yield value
+
+    def filter(self, iterable):
+        """ Filter the given iterable down to a list of the items that contain any of our patterns.
+
+            :param iterable: The iterable to filter.
+            :return: The filtered list.
+        """
+        return list(self.ifilter(iterable))
 
 
 def filter_by_value(list_, filter_values):
@@ -28,26 +188,65 @@ def filter_by_value(list_, filter_values):
 
         :note: Objects in the list will be compared as strings, but they will be returned in their original form.
     
+        :note: Numeric NumPy arrays filtered by numeric values are filtered by equality (numpy.isin),
+            and NumPy arrays of integers or strings are filtered into a NumPy array through a boolean mask.
+
         :param list_: The list to filter.
-        :param filter_values: A list of search expressions to filter by.
-        :return: The filtered list.
+        :param filter_values: A list of search expressions to filter by, or a MultiPatternMatcher built from them.
+        :return: The filtered list, with each matching item included once.
     """
-    filtered_list = []
+    if _is_numpy_array(list_) and list_.ndim == 1:
+        filtered_array = _numpy_filter_by_value(list_, filter_values)
 
-    for value in list_:
-        for filter_value in filter_values:
-            if filter_value in str(value):
-                filtered_list.append(value)
+        if filtered_array is not None:
+            return filtered_array
 
-    return filtered_list
+    if not isinstance(filter_values, MultiPatternMatcher):
+        filter_values = MultiPatternMatcher(filter_values)
+
+    return filter_values.filter(list_)
+
+
+def _numpy_filter_by_value(array_, filter_values):
+    """ Vectorized implementation of filter_by_value for one dimensional NumPy arrays.
+
+        :param array_: The array to filter.
+        :param filter_values: The values to filter by, or a MultiPatternMatcher built from them.
+        :return: The filtered array, or None if the array and filter values do not qualify.
+    """
+    kind = array_.dtype.kind
+
+    if not isinstance(filter_values, MultiPatternMatcher):
+        filter_values = tuple(filter_values)
+
+        if filter_values and kind in 'biuf' and all(isinstance(value, numbers.Number) for value in filter_values):
+            return array_[numpy.isin(array_, filter_values)]
+
+        if not all(isinstance(value, basestring) for value in filter_values):
+            return None
+
+        filter_values = MultiPatternMatcher(filter_values)
+
+    # Only integer and string dtypes format the same way as str() does on their python equivalent.
+    if kind not in 'iuSU':
+        return None
+
+    # numpy.char substring searches loop in python internally, scanning the plain python values once is faster.
+    mask = numpy.fromiter(itertools.imap(filter_values.matches, array_.tolist()), dtype=bool, count=len(array_))
+    return array_[mask]
 
 
 def pairwise(iterable):
     """ Iterate through the given iterable two elements at a time.
 
+        :note: One dimensional NumPy arrays are returned as a read-only (n - 1, 2) strided view of the array.
+
         :param iterable: The iterable to loop through.
         :return: Generator that iterates through the iterable two elements at a time.
     """
+    if _is_numpy_array(iterable) and iterable.ndim == 1:
+        return _numpy_windows(iterable, 2, 1)
+
     a, b = itertools.tee(iterable)
     next(b, None)
     return itertools.izip(a, b)
@@ -56,11 +255,385 @@ def pairwise(iterable):
 def flatten(iterable):
     """ Given an iterable of iterables, flatten out the embedded rows into one list.
     
+        :note: NumPy arrays, and lists or tuples of NumPy arrays, are flattened into a NumPy array.
+
         :param iterable: The iterable to flatten.
     """
+    if _is_numpy_array(iterable) and iterable.ndim > 1:
+        return iterable.reshape((-1,) + iterable.shape[2:])
+
+    if numpy is not None and isinstance(iterable, (list, tuple)) and iterable \
+            and all(isinstance(row, numpy.ndarray) and row.ndim > 0 for row in iterable):
+        trailing_shape = iterable[0].shape[1:]
+
+        # Rows of differing shapes cannot be concatenated, they are flattened into a list as any other rows.
+        if all(row.shape[1:] == trailing_shape for row in iterable):
+            return numpy.concatenate(iterable)
+
     new_list = []
 
     for row in iterable:
         new_list.extend(row)
 
     return new_list
+
+
+def iflatten(iterable, depth=1):
+    """ Lazily flatten out embedded iterables, up to the given depth.
+
+        :note: Strings and buffers are never split into their characters, they are yielded as single elements.
+
+        :param iterable: The iterable to flatten.
+        :param depth: How many levels of embedded iterables to flatten, None to flatten all of them.
+        :return: Generator that yields the flattened elements.
+    """
+    for item in iterable:
+        if depth == 0 or isinstance(item, (basestring, bytearray, memoryview, buffer)) or not hasattr(item, '__iter__'):
+            yield item
+            continue
+
+        for flattened_item in iflatten(item, None if depth is None else depth - 1):
+            yield flattened_item
+
+
+def _buffer_slicer(iterable):
+    """ If the given iterable supports slicing into views or arrays, return a function that slices it,
+        along with its length in elements.
+
+        :note: On python 2, array.array only supports the old buffer interface, whose buffer objects hold raw bytes,
+            so arrays are sliced into (copied) arrays to keep their element type.
+
+        :param iterable: The iterable to check.
+        :return: A (slice_function, length) tuple, or None if the iterable cannot be sliced.
+    """
+    if isinstance(iterable, array.array):
+        return lambda start, stop: iterable[start:stop], len(iterable)
+
+    if isinstance(iterable, (str, bytearray, memoryview)):
+        view = memoryview(iterable)
+        return lambda start, stop: view[start:stop], len(view)
+
+    return None
+
+
+def windowed(iterable, n, step=1):
+    """ Iterate through the given iterable in sliding windows of n elements, advancing step elements at a time,
+        only complete windows are returned. windowed(iterable, 2) is equivalent to pairwise(iterable).
+
+        :note: Strings, bytearrays and memoryviews are sliced into zero-copy memoryviews, arrays into arrays,
+            and one dimensional NumPy arrays are returned as a read-only strided view with one row per window.
+
+        :param iterable: The iterable to loop through.
+        :param n: The number of elements in each window.
+        :param step: The number of elements to advance between windows.
+        :raise ValueError: If n or step is less than 1.
+        :return: Generator that yields each window, as a tuple unless noted above.
+    """
+    if n < 1 or step < 1:
+        raise ValueError('Window size and step must be at least 1')
+
+    if _is_numpy_array(iterable) and iterable.ndim == 1:
+        return _numpy_windows(iterable, n, step)
+
+    slicer = _buffer_slicer(iterable)
+
+    if slicer:
+        slice_, length = slicer
+        return (slice_(start, start + n) for start in xrange(0, length - n + 1, step))
+
+    return _iter_windows(iterable, n, step)
+
+
+def _numpy_windows(array_, n, step):
+    """ Vectorized implementation of windowed for one dimensional NumPy arrays, using stride tricks
+        to view the array as a two dimensional array of windows without copying it.
+    """
+    window_count = max(0, (len(array_) - n) // step + 1)
+    stride = array_.strides[0]
+    return as_strided(array_, shape=(window_count, n), strides=(stride * step, stride), writeable=False)
+
+
+def _iter_windows(iterable, n, step):
+    """ Generator implementation of windowed for arbitrary iterables.
+    """
+    iterator = iter(iterable)
+    window = deque(itertools.islice(iterator, n), maxlen=n)
+
+    if len(window) < n:
+        return
+
+    yield tuple(window)
+
+    while True:
+        advance = tuple(itertools.islice(iterator, step))
+
+        if len(advance) < step:
+            return
+
+        window.extend(advance)
+        yield tuple(window)
+
+
+def batched(iterable, n):
+    """ Iterate through the given iterable n elements at a time, the last batch may be shorter.
+
+        :note: Strings, bytearrays and memoryviews are sliced into zero-copy memoryviews, arrays into arrays.
+
+        :param iterable: The iterable to loop through.
+        :param n: The number of elements in each batch.
+        :raise ValueError: If n is less than 1.
+        :return: Generator that yields each batch, as a tuple unless noted above.
+    """
+    if n < 1:
+        raise ValueError('Batch size must be at least 1')
+
+    slicer = _buffer_slicer(iterable)
+
+    if slicer:
+        slice_, length = slicer
+        return (slice_(start, min(start + n, length)) for start in xrange(0, length, n))
+
+    return _iter_batches(iterable, n)
+
+
+def _iter_batches(iterable, n):
+    """ Generator implementation of batched for arbitrary iterables.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        batch = tuple(itertools.islice(iterator, n))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def _chunk_size(item_count, processes):
+    """ Pick a chunk size that splits the items into about four chunks per process, same as Pool.map does.
+    """
+    chunk_size, remainder = divmod(item_count, processes * 4)
+
+    if remainder:
+        chunk_size += 1
+
+    return max(chunk_size, 1)
+
+
+def parallel_map(function, iterable, processes=None, chunksize=None, ordered=True,
+                 minimum_items=PARALLEL_MINIMUM_ITEMS):
+    """ Apply function to every element of the given iterable on a pool of processes.
+
+        :note: function and the elements must be picklable, so function has to be defined at module level.
+
+        :param function: The function to apply.
+        :param iterable: The iterable to map.
+        :param processes: The number of processes to use, defaults to the number of cpus.
+        :param chunksize: The number of elements sent to a process at a time, chosen automatically by default.
+        :param ordered: Whether to return the results in input order, or yield them as soon as they are done.
+        :param minimum_items: Iterables with fewer elements are mapped in-process instead.
+        :return: The list of results if ordered, else a generator that yields the results in completion order.
+    """
+    items = iterable if isinstance(iterable, (list, tuple)) else list(iterable)
+
+    if len(items) < minimum_items:
+        results = itertools.imap(function, items)
+        return list(results) if ordered else results
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = chunksize or _chunk_size(len(items), processes)
+
+    if not ordered:
+        return _imap_unordered(function, items, processes, chunksize)
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        return pool.map(function, items, chunksize)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _imap_unordered(function, items, processes, chunksize):
+    """ Generator implementation of parallel_map for unordered results, the pool lives as long as the generator.
+    """
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for result in pool.imap_unordered(function, items, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _test_item(predicate, item):
+    """ Worker side of an ordered parallel_filter, only the boolean result is sent back.
+    """
+    return bool(predicate(item))
+
+
+def _filter_item(predicate, item):
+    """ Worker side of an unordered parallel_filter, the item is sent back along with the boolean result.
+    """
+    return bool(predicate(item)), item
+
+
+def parallel_filter(predicate, iterable, processes=None, chunksize=None, ordered=True,
+                    minimum_items=PARALLEL_MINIMUM_ITEMS):
+    """ Filter the given iterable down to the elements predicate returns True for, testing them on a pool of processes.
+
+        :note: predicate and the elements must be picklable, so predicate has to be defined at module level.
+
+        :param predicate: The function to test each element with.
+        :param iterable: The iterable to filter.
+        :param processes: The number of processes to use, defaults to the number of cpus.
+        :param chunksize: The number of elements sent to a process at a time, chosen automatically by default.
+        :param ordered: Whether to return the elements in input order, or yield them as soon as they are tested.
+        :param minimum_items: Iterables with fewer elements are filtered in-process instead.
+        :return: The filtered list if ordered, else a generator that yields the elements in completion order.
+    """
+    items = iterable if isinstance(iterable, (list, tuple)) else list(iterable)
+
+    if ordered:
+        results = parallel_map(functools.partial(_test_item, predicate), items, processes, chunksize, True,
+                               minimum_items)
+        return [item for item, keep in itertools.izip(items, results) if keep]
+
+    results = parallel_map(functools.partial(_filter_item, predicate), items, processes, chunksize, False,
+                           minimum_items)
+    return (item for keep, item in results if keep)
+
+
+class _ReverseKey(object):
+    """ Wrapper that inverts the ordering of a sort key, heapq.merge has no reverse argument on python 2.
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def _spill_run(run, temp_directory):
+    """ Write a sorted run to an anonymous temporary file, in pickled blocks of elements.
+
+        :return: The temporary file, rewound to the start of the run.
+    """
+    run_file = tempfile.TemporaryFile(dir=temp_directory)
+
+    for block in batched(run, _RUN_BLOCK_SIZE):
+        cPickle.dump(block, run_file, cPickle.HIGHEST_PROTOCOL)
+
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file, run_index, key, reverse):
+    """ Lazily read back a run written by _spill_run, decorating each element so heapq.merge
+        orders them by key, keeps equal keys in input order, and never compares the elements themselves.
+    """
+    sequence = 0
+
+    while True:
+        try:
+            block = cPickle.load(run_file)
+        except EOFError:
+            return
+
+        for item in block:
+            sort_key = item if key is None else key(item)
+            yield (_ReverseKey(sort_key) if reverse else sort_key), run_index, sequence, item
+            sequence += 1
+
+
+def external_sort(iterable, key=None, reverse=False, run_size=EXTERNAL_RUN_SIZE, temp_directory=None):
+    """ Sort an iterable that may not fit in memory. Elements are sorted in runs of run_size,
+        every run is spilled to a temporary file, and the runs are merged back with heapq.merge.
+        If the whole iterable fits in one run, it is sorted in memory and nothing is written to disk.
+
+        :note: Elements must be picklable. The sort is stable, like sorted.
+
+        :param iterable: The iterable to sort.
+        :param key: Optional function that returns the key to sort each element by.
+        :param reverse: Whether to sort in descending order.
+        :param run_size: The maximum number of elements to hold in memory at once.
+        :param temp_directory: The directory to write runs to, defaults to the system temporary directory.
+        :raise ValueError: If run_size is less than 1.
+        :return: Generator that yields the sorted elements.
+    """
+    if run_size < 1:
+        raise ValueError('Run size must be at least 1')
+
+    return _iter_external_sort(iterable, key, reverse, run_size, temp_directory)
+
+
+def _iter_external_sort(iterable, key, reverse, run_size, temp_directory):
+    """ Generator implementation of external_sort.
+    """
+    iterator = iter(iterable)
+    run_files = []
+
+    try:
+        while True:
+            run = list(itertools.islice(iterator, run_size))
+            run.sort(key=key, reverse=reverse)
+
+            if len(run) < run_size and not run_files:
+                for item in run:
+                    yield item
+
+                return
+
+            if run:
+                run_files.append(_spill_run(run, temp_directory))
+
+            if len(run) < run_size:
+                break
+
+            # Release the run before reading the next one, so only one run is ever held in memory.
+            del run
+
+        runs = [_read_run(run_file, run_index, key, reverse) for run_index, run_file in enumerate(run_files)]
+
+        for sort_key, run_index, sequence, item in heapq.merge(*runs):
+            yield item
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def external_unique(iterable, key=None, run_size=EXTERNAL_RUN_SIZE, temp_directory=None):
+    """ Remove duplicates from an iterable that may not fit in memory, through external_sort.
+
+        :param iterable: The iterable to deduplicate.
+        :param key: Optional function that returns the key elements are compared by,
+            the first element (in input order) with each key is kept.
+        :param run_size: The maximum number of elements to hold in memory at once.
+        :param temp_directory: The directory to write runs to, defaults to the system temporary directory.
+        :return: Generator that yields the unique elements, in sorted order.
+    """
+    for group_key, group in external_groupby(iterable, key, run_size, temp_directory):
+        yield next(group)
+
+
+def external_groupby(iterable, key=None, run_size=EXTERNAL_RUN_SIZE, temp_directory=None):
+    """ Group the elements of an iterable that may not fit in memory by key, through external_sort.
+        Unlike itertools.groupby, elements with the same key do not need to be adjacent in the input.
+
+        :param iterable: The iterable to group.
+        :param key: Optional function that returns the key to group each element by.
+        :param run_size: The maximum number of elements to hold in memory at once.
+        :param temp_directory: The directory to write runs to, defaults to the system temporary directory.
+        :raise ValueError: If run_size is less than 1.
+        :return: Generator that yields (key, group) tuples in key order, each group is itself a lazy iterator
+            that is only valid until the next group is requested, same as itertools.groupby.
+    """
+    return itertools.groupby(external_sort(iterable, key, run_size=run_size, temp_directory=temp_directory), key)
@@ -4,19 +4,65 @@
 Author: Ian Davis
 """
 
+import Queue
+import atexit
+import bisect
+import cPickle
+import datetime
+import errno
+import gzip
+import json
 import logging
+import mmap
+import os
+import random
 import re
+import shutil
+import socket
 import sre_constants
+import struct
 import sys
+import threading
+import time
+import zlib
 
+from collections import deque, namedtuple
+from json.encoder import encode_basestring_ascii
 from logging.handlers import RotatingFileHandler
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
 
 from colorlog import ColoredFormatter
 
 from python_utilities import os_util
 
+# Overflow policies of a QueueHandler, for when its queue is full.
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEW = 'drop-new'
 
-def initialize(name, filepath, level, console_output=False, log_colors=None, regex_filter=None, max_size=100):
+# Record fields a RegexFilter can match on, every field but MESSAGE is available without formatting the record.
+MESSAGE = 'message'
+TEMPLATE = 'template'
+NAME = 'name'
+LEVEL = 'level'
+
+_listeners = []
+
+# The number of random bytes in the authentication key of a LogAggregator.
+AUTHKEY_SIZE = 32
+
+# How often QueueListener.stop queues its sentinel again, in seconds, in case a DROP_OLDEST QueueHandler dropped it.
+STOP_RETRY_INTERVAL = 0.5
+
+# A record read back from a log file by a LogReader, time is in seconds since the epoch and level is numeric.
+LogEntry = namedtuple('LogEntry', 'time level name message')
+
+
+def initialize(name, filepath, level, console_output=False, log_colors=None, regex_filter=None, max_size=100,
+               asynchronous=False, queue_size=10000, overflow_policy=BLOCK, buffered=False, backup_count=2,
+               structured=False, rate_limit=None, sample_rate=None, suppress_duplicates=False, flight_recorder=0,
+               flight_recorder_path=None, aggregator=None, clear=True):
     """ Initialize logger settings for the logger name specified.
 
         :param name: The name of the logger to initialize (can be None to configure the root logger).
@@ -24,10 +70,41 @@ def initialize(name, filepath, level, console_output=False, log_colors=None, reg
         :param level: The level to use for logging.
         :param console_output: Flag to indicate whether or not to reflect log to console or not.
         :param log_colors: Custom dictionary mapping level names to color types.
-        :param regex_filter: Should be a regular expression string that will be matched against any records logged.
+        :param regex_filter: Should be a regular expression string (or a list of them) that will be matched
+            against any records logged, or a RegexFilter instance.
         :param max_size: The maximum size of the log file (in kilobytes, defaults to 100).
+        :param asynchronous: Flag to indicate whether logging calls should only queue records,
+            leaving formatting and writing them to a background thread (see shutdown).
+        :param queue_size: The maximum number of records waiting in the queue, when asynchronous.
+        :param overflow_policy: What to do when the queue is full, one of BLOCK, DROP_OLDEST or DROP_NEW.
+        :param buffered: Flag to indicate whether to buffer writes to the log file, and rotate and gzip it
+            on background threads (see BufferedRotatingFileHandler).
+        :param backup_count: The number of rotated log files to keep.
+        :param structured: Flag to indicate whether to write the log file as JSON lines (see JsonFormatter).
+        :param rate_limit: The maximum number of records per second to let through for each message template.
+        :param sample_rate: The fraction (0 to 1) of DEBUG and INFO records to let through.
+        :param suppress_duplicates: Flag to indicate whether to collapse repeated records into a
+            "last message repeated N times" record (see ThrottlingHandler).
+        :param flight_recorder: The number of records of every level to keep in a RingBufferHandler,
+            which writes them out when an ERROR is logged (or on dump_flight_recorder), 0 to disable.
+        :param flight_recorder_path: Optional path of a file to map the flight recorder to,
+            so its records survive a crash and are written out on the next initialize.
+        :param aggregator: True (or an explicit multiprocessing.connection address) to share the log file between
+            processes, the first process to initialize it owns the file and runs a LogAggregator, the others
+            send their records to it in batches through an AggregatingHandler. They authenticate with a key kept
+            in filepath.key, which only the user running them can read.
+        :param clear: Flag to indicate whether to truncate the log file first (only done by the owning process
+            when aggregating).
     """
-    os_util.clear_file(filepath)
+    owner_listener = None
+
+    if aggregator:
+        address = _aggregator_address(filepath) if aggregator is True else aggregator
+        authkey = _aggregator_authkey(filepath)
+        owner_listener = _bind_aggregator(address)
+
+    if clear and (not aggregator or owner_listener):
+        os_util.clear_file(filepath)
 
     logger = logging.getLogger(name)
     logger.propagate = False
@@ -45,31 +122,1612 @@ def initialize(name, filepath, level, console_output=False, log_colors=None, reg
                                          reset=True,
                                          log_colors=log_colors)
 
-    file_formatter = logging.Formatter('[%(name)s][%(levelname)s-%(asctime)s]: %(message)s',
-                                       datefmt="%Y-%m-%d %H:%M:%S")
+    if structured:
+        file_formatter = JsonFormatter()
+    else:
+        file_formatter = logging.Formatter('[%(name)s][%(levelname)s-%(asctime)s]: %(message)s',
+                                           datefmt="%Y-%m-%d %H:%M:%S")
+
+    if aggregator and not owner_listener:
+        file_handler = AggregatingHandler(address, authkey=authkey)
+    elif buffered:
+        file_handler = BufferedRotatingFileHandler(filepath, max_bytes=max_size*1024, backup_count=backup_count)
+    else:
+        file_handler = RotatingFileHandler(filepath, mode='a', maxBytes=max_size*1024, backupCount=backup_count)
 
-    file_handler = RotatingFileHandler(filepath, mode='a', maxBytes=max_size*1024, backupCount=2)
     stream_handler = logging.StreamHandler(sys.stdout)
 
     file_handler.setFormatter(file_formatter)
     stream_handler.setFormatter(colored_formatter)
 
+    handlers = [file_handler]
+
+    if console_output:
+        handlers.append(stream_handler)
+
+    if owner_listener:
+        log_aggregator = LogAggregator(owner_listener, authkey, file_handler)
+        log_aggregator.start()
+        _register_listener(log_aggregator)
+
+    if asynchronous:
+        log_queue = Queue.Queue(maxsize=queue_size)
+        listener = QueueListener(log_queue, *handlers)
+        listener.start()
+        _register_listener(listener)
+        handlers = [QueueHandler(log_queue, overflow_policy=overflow_policy)]
+
+    if rate_limit or sample_rate is not None or suppress_duplicates:
+        handlers = [ThrottlingHandler(handlers, rate_limit=rate_limit, sample_rate=sample_rate,
+                                      suppress_duplicates=suppress_duplicates)]
+
+    if flight_recorder:
+        # The logger lets every record through to the flight recorder, the other handlers apply the level instead.
+        for handler in handlers:
+            handler.setLevel(level)
+
+        flight_recorder_handler = RingBufferHandler(list(handlers), capacity=flight_recorder, path=flight_recorder_path)
+        flight_recorder_handler.dump()
+        handlers.insert(0, flight_recorder_handler)
+        level = logging.DEBUG
+
     logger.setLevel(level)
-    logger.addHandler(file_handler)
+
+    for handler in handlers:
+        logger.addHandler(handler)
 
     if regex_filter:
-        logger.addFilter(RegexFilter(regex_filter))
+        if not isinstance(regex_filter, RegexFilter):
+            regex_filter = RegexFilter(regex_filter)
 
-    if console_output:
-        logger.addHandler(stream_handler)
+        logger.addFilter(regex_filter)
+
+
+def dump_flight_recorder(name):
+    """ Write out the records held by the flight recorder of the given logger, if it has one.
+
+        :param name: The name of the logger (can be None for the root logger).
+    """
+    for handler in logging.getLogger(name).handlers:
+        if isinstance(handler, RingBufferHandler):
+            handler.dump()
+
+
+def _register_listener(listener):
+    """ Keep track of a started background listener, so shutdown stops it.
+    """
+    if not _listeners:
+        atexit.register(shutdown)
+
+    _listeners.append(listener)
+
+
+def _aggregator_address(filepath):
+    """ Return the address of the LogAggregator for a log file, a unix socket next to it,
+        or a localhost port derived from its path on Windows.
+    """
+    filepath = os.path.abspath(filepath)
+
+    if os.name == 'nt':
+        return 'localhost', 20000 + (zlib.crc32(filepath) & 0xffffffff) % 20000
+
+    return filepath + '.sock'
+
+
+def _aggregator_authkey(filepath):
+    """ Return the key the processes sharing a log file authenticate their connections to its LogAggregator with,
+        as records are unpickled. It is kept in a file next to the log file that only its owner can read,
+        the first process to need it creates it with a random key.
+    """
+    key_path = os.path.abspath(filepath) + '.key'
+
+    try:
+        descriptor = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0600)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    else:
+        with os.fdopen(descriptor, 'wb') as key_file:
+            key_file.write(os.urandom(AUTHKEY_SIZE))
+
+    # Another process may have created the file but not written its key yet.
+    for _ in xrange(100):
+        with open(key_path, 'rb') as key_file:
+            authkey = key_file.read()
+
+        if len(authkey) >= AUTHKEY_SIZE:
+            return authkey
+
+        time.sleep(0.01)
+
+    raise IOError('Invalid log aggregator key file: {0}'.format(key_path))
+
+
+def _bind_aggregator(address):
+    """ Listen on the address of a LogAggregator, replacing a unix socket left behind by a process that died.
+
+        :param address: The address to listen on.
+        :return: The Listener, or None if another process is already listening on the address.
+    """
+    try:
+        return Listener(address)
+    except socket.error as error:
+        if error.errno != errno.EADDRINUSE:
+            raise
+
+    try:
+        Client(address).close()
+        return None
+    except socket.error:
+        if isinstance(address, tuple):
+            raise
+
+    os.remove(address)
+    return Listener(address)
+
+
+def shutdown():
+    """ Stop every background logging thread started by initialize, after writing out all queued records.
+        This is registered to run at exit, but can be called earlier to flush the logs.
+    """
+    while _listeners:
+        _listeners.pop().stop()
 
 
 class RegexFilter(object):
-    def __init__(self, regex_pattern):
+    """ Logging filter that only lets through records whose field matches (from the start, like re.match)
+        any of the include patterns and none of the exclude patterns.
+
+        Each list of patterns is compiled into a single alternation. Matching on the TEMPLATE
+        (the unformatted record.msg), NAME or LEVEL fields avoids formatting the message,
+        and since those values repeat, the decision for each value is cached.
+
+    :param regex_pattern: A regular expression string, or a list of them, to include. None includes everything.
+    :param exclude: A regular expression string, or a list of them, to exclude.
+    :param field: The record field to match on, one of MESSAGE, TEMPLATE, NAME or LEVEL.
+    :param cache_size: The maximum number of cached decisions, the cache is cleared when it is full.
+    :raise ValueError: If any of the patterns is invalid, or the field is unknown.
+    """
+
+    def __init__(self, regex_pattern=None, exclude=None, field=MESSAGE, cache_size=1024):
+        if field not in (MESSAGE, TEMPLATE, NAME, LEVEL):
+            raise ValueError('Unknown logging filter field: {0}'.format(field))
+
+        self.include = self._compile(regex_pattern)
+        self.exclude = self._compile(exclude)
+        self.field = field
+        self.cache_size = cache_size
+        self._decisions = {}
+
+    @staticmethod
+    def _compile(patterns):
+        """ Compile a pattern, or a list of patterns, into a single regular expression.
+
+            :param patterns: A regular expression string, a list of them, or None.
+            :raise ValueError: If any of the patterns is invalid.
+            :return: The compiled expression, or None if there are no patterns.
+        """
+        if not patterns:
+            return None
+
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+
         try:
-            self.pattern = re.compile(regex_pattern)
+            return re.compile('|'.join('(?:{0})'.format(pattern) for pattern in patterns))
         except sre_constants.error:
             raise ValueError('Logging filter expression invalid!')
 
+    def _field_value(self, record):
+        """ Return the value of our (pre-format) field for the given record.
+        """
+        if self.field == TEMPLATE:
+            return record.msg if isinstance(record.msg, basestring) else str(record.msg)
+        elif self.field == NAME:
+            return record.name
+
+        return record.levelname
+
+    def _decide(self, value):
+        """ Return whether the given value passes our include and exclude patterns.
+        """
+        if self.include and not self.include.match(value):
+            return False
+
+        return not (self.exclude and self.exclude.match(value))
+
     def filter(self, record):
-        return bool(self.pattern.match(record.getMessage()))
+        if self.field == MESSAGE:
+            return self._decide(record.getMessage())
+
+        value = self._field_value(record)
+
+        try:
+            return self._decisions[value]
+        except KeyError:
+            pass
+
+        if len(self._decisions) >= self.cache_size:
+            self._decisions.clear()
+
+        decision = self._decisions[value] = self._decide(value)
+        return decision
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formatter that renders each record as a single line JSON object, for machine consumption.
+
+        Every object holds the epoch timestamp, the local time, the level, the logger name and the message,
+        followed by the exception (if any) and every extra field passed to the logging call.
+        The rendered local time is cached for the current second, and the fixed parts of the line
+        are precomputed, so only the message and extra fields go through the JSON encoder.
+
+    :param datefmt: The strftime format of the local time field.
+    """
+
+    # Attributes every LogRecord has, anything else on a record was passed through extra.
+    _reserved_attributes = frozenset(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) \
+        .union(('message', 'asctime'))
+
+    _template = '{"timestamp": %.6f, "time": %s, "level": %s, "logger": %s, "message": %s'
+
+    def __init__(self, datefmt='%Y-%m-%dT%H:%M:%S'):
+        logging.Formatter.__init__(self, datefmt=datefmt)
+        self._cached_second = None
+        self._cached_time = None
+        self._encoded_names = {}
+        self._encoded_levels = {}
+        self._encode_extra = json.JSONEncoder(default=str).encode
+
+    def _render_time(self, created):
+        """ Return the local time field for the given epoch time, rendering it only once per second.
+        """
+        second = int(created)
+
+        if second != self._cached_second:
+            self._cached_time = encode_basestring_ascii(time.strftime(self.datefmt, self.converter(second)))
+            self._cached_second = second
+
+        return self._cached_time
+
+    def format(self, record):
+        name = self._encoded_names.get(record.name)
+
+        if name is None:
+            name = self._encoded_names[record.name] = encode_basestring_ascii(record.name)
+
+        level = self._encoded_levels.get(record.levelname)
+
+        if level is None:
+            level = self._encoded_levels[record.levelname] = encode_basestring_ascii(record.levelname)
+
+        line = self._template % (record.created, self._render_time(record.created), level, name,
+                                 encode_basestring_ascii(record.getMessage()))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            line += ', "exception": ' + encode_basestring_ascii(record.exc_text)
+
+        extra_keys = record.__dict__.viewkeys() - self._reserved_attributes
+
+        if extra_keys:
+            line += ''.join(', {0}: {1}'.format(encode_basestring_ascii(key), self._encode_extra(record.__dict__[key]))
+                            for key in extra_keys)
+
+        return line + '}'
+
+
+class ThrottlingHandler(logging.Handler):
+    """ Handler that passes records on to its target handlers, after cutting down floods of records.
+
+        Three mechanisms are available, checked in this order:
+            - suppress_duplicates: a record identical to the last one let through is only counted,
+              and a "last message repeated N times" record is sent once a different record arrives.
+            - sample_rate: records below sample_level are let through with the given probability.
+            - rate_limit: each message template (logger name and unformatted message) gets a token bucket
+              refilled at rate_limit tokens per second, holding at most burst tokens.
+        Every report_interval seconds, a background thread sends a WARNING record reporting the number of records
+        suppressed by sampling and by each rate limited template, so nothing is lost silently.
+
+    :param targets: The handlers to pass records on to.
+    :param rate_limit: The number of records per second to let through for each template, None for no limit.
+    :param burst: The maximum number of records let through at once for each template, defaults to rate_limit
+        (and is at least 1, so rates below one record per second still let records through).
+    :param sample_rate: The fraction of records below sample_level to let through, None to not sample.
+    :param sample_level: Records at this level and above are never sampled.
+    :param suppress_duplicates: Whether to collapse repeated records.
+    :param report_interval: The time, in seconds, between reports of suppressed records.
+    :raise ValueError: If rate_limit is not positive.
+    """
+
+    # Templates beyond this many are not tracked individually, the buckets are reset instead.
+    max_templates = 10000
+
+    def __init__(self, targets, rate_limit=None, burst=None, sample_rate=None, sample_level=logging.WARNING,
+                 suppress_duplicates=False, report_interval=60.0):
+        if rate_limit is not None and rate_limit <= 0:
+            raise ValueError('Rate limit must be positive: {0}'.format(rate_limit))
+
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.rate_limit = rate_limit
+        self.burst = max(1, burst or rate_limit) if rate_limit else None
+        self.sample_rate = sample_rate
+        self.sample_level = sample_level
+        self.suppress_duplicates = suppress_duplicates
+        self.report_interval = report_interval
+
+        self._buckets = {}
+        self._rate_limited = {}
+        self._sampled = 0
+        self._last_record = None
+        self._last_key = None
+        self._repeated = 0
+        self._last_report = time.time()
+        self._closed = threading.Event()
+        self._reporter = threading.Thread(target=self._report_periodically)
+        self._reporter.daemon = True
+        self._reporter.start()
+
+    def _forward(self, record):
+        """ Pass a record on to each target handler whose level it meets.
+        """
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    @staticmethod
+    def _template_key(record):
+        """ Return the key identifying the message template of a record.
+        """
+        message = record.msg if isinstance(record.msg, basestring) else str(record.msg)
+        return record.name, message
+
+    def _take_token(self, key, now):
+        """ Take a token from the bucket of the given template, refilling it for the time passed first.
+
+            :return: True if there was a token to take, else False.
+        """
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            if len(self._buckets) >= self.max_templates:
+                self._buckets.clear()
+
+            bucket = self._buckets[key] = [self.burst, now]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+
+        bucket[0] = tokens - 1
+        return True
+
+    def _report_repeated(self):
+        """ Send the "last message repeated N times" record for the current run of duplicates, if any.
+        """
+        if not self._repeated:
+            return
+
+        last_record = self._last_record
+        self._forward(logging.LogRecord(last_record.name, last_record.levelno, last_record.pathname,
+                                        last_record.lineno, 'Last message repeated %d times', (self._repeated,), None))
+        self._repeated = 0
+
+    def report(self):
+        """ Send records reporting every record suppressed since the last report.
+        """
+        self._report_repeated()
+
+        if self._sampled:
+            self._forward(logging.LogRecord(self.name or __name__, logging.WARNING, __file__, 0,
+                                            'Sampling suppressed %d records', (self._sampled,), None))
+            self._sampled = 0
+
+        for (logger_name, template), count in self._rate_limited.iteritems():
+            self._forward(logging.LogRecord(logger_name, logging.WARNING, __file__, 0,
+                                            'Rate limit suppressed %d records like: %s', (count, template), None))
+
+        self._rate_limited = {}
+        self._last_report = time.time()
+
+    def _report_periodically(self):
+        """ Target of the report thread, report the suppressed records every report_interval seconds until closed.
+        """
+        while not self._closed.wait(self.report_interval):
+            self.acquire()
+
+            try:
+                self.report()
+            finally:
+                self.release()
+
+    def emit(self, record):
+        now = time.time()
+
+        if now - self._last_report >= self.report_interval:
+            self.report()
+
+        if self.suppress_duplicates:
+            key = (record.name, record.levelno, record.msg, record.args)
+
+            if self._last_key is not None and key == self._last_key:
+                self._repeated += 1
+                return
+
+        if self.sample_rate is not None and record.levelno < self.sample_level and random.random() >= self.sample_rate:
+            self._sampled += 1
+            return
+
+        if self.rate_limit:
+            template_key = self._template_key(record)
+
+            if not self._take_token(template_key, now):
+                self._rate_limited[template_key] = self._rate_limited.get(template_key, 0) + 1
+                return
+
+        if self.suppress_duplicates:
+            self._report_repeated()
+            self._last_key = key
+            self._last_record = record
+
+        self._forward(record)
+
+    def flush(self):
+        self.acquire()
+
+        try:
+            self.report()
+        finally:
+            self.release()
+
+        for target in self.targets:
+            target.flush()
+
+    def close(self):
+        self._closed.set()
+
+        if self._reporter is not threading.current_thread():
+            self._reporter.join()
+
+        logging.Handler.close(self)
+
+
+class _MappedRing(object):
+    """ Circular byte buffer backed by a memory mapped file, so its contents outlive the process.
+
+    :param path: The path of the file to map.
+    :param size: The number of bytes of data to hold.
+    """
+    _header = struct.Struct('<4sQI')
+    _magic = 'PURB'
+
+    def __init__(self, path, size):
+        self.size = size
+        total_size = self._header.size + size
+        reuse = os.path.exists(path) and os.path.getsize(path) == total_size
+
+        file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT)
+
+        try:
+            if not reuse:
+                os.ftruncate(file_descriptor, total_size)
+
+            self._map = mmap.mmap(file_descriptor, total_size)
+        finally:
+            os.close(file_descriptor)
+
+        magic, self.offset, self.wrapped = self._header.unpack_from(self._map, 0)
+
+        if magic != self._magic or self.offset > size:
+            self.clear()
+
+    def _write_header(self):
+        self._header.pack_into(self._map, 0, self._magic, self.offset, self.wrapped)
+
+    def append(self, data):
+        """ Append data to the ring, overwriting the oldest data once it is full.
+
+            :param data: The bytes to append, at most size bytes.
+        """
+        start = self._header.size + self.offset
+        first_part = min(len(data), self.size - self.offset)
+        self._map[start:start + first_part] = data[:first_part]
+
+        if first_part < len(data):
+            remainder = len(data) - first_part
+            self._map[self._header.size:self._header.size + remainder] = data[first_part:]
+            self.offset = remainder
+            self.wrapped = 1
+        else:
+            self.offset += first_part
+
+            if self.offset == self.size:
+                self.offset = 0
+                self.wrapped = 1
+
+        self._write_header()
+
+    def read(self):
+        """ Return the data in the ring, oldest first, starting at the first complete line.
+        """
+        data_start = self._header.size
+
+        if not self.wrapped:
+            return self._map[data_start:data_start + self.offset]
+
+        data = self._map[data_start + self.offset:data_start + self.size] + self._map[data_start:data_start + self.offset]
+        return data[data.find('\n') + 1:]
+
+    def clear(self):
+        self.offset = 0
+        self.wrapped = 0
+        self._write_header()
+
+    def close(self):
+        self._map.close()
+
+
+class RingBufferHandler(logging.Handler):
+    """ Flight recorder handler that keeps the last capacity records of every level in a ring buffer,
+        and writes them out to its targets when a record at dump_level or above is logged, or on dump.
+
+        Only records below the level of a target are written to it, since it already received the others.
+        Those records are older than some the target already wrote, so a dump is written as a block between
+        "flight recorder dump begins/ends" marker records, and each dumped record is stamped with the time of
+        the dump, its own time being prepended to its message. Log files therefore stay in chronological order
+        (as LogReader expects), while the dumped records keep their place in the timeline through their message.
+        Capturing a record is just a deque append, unless the buffer is mapped to a file (path),
+        in which case the message is formatted and copied into the mapped file so it survives a crash.
+        The mapped buffer is cleared on close, so anything found in it on startup is from a crashed process.
+
+    :param targets: The handlers to write the buffered records to.
+    :param capacity: The number of records to keep.
+    :param dump_level: Records at or above this level trigger a dump.
+    :param path: Optional path of a file to map the buffer to.
+    :param record_size: The average size, in bytes, to reserve per record in the mapped file.
+    """
+
+    def __init__(self, targets, capacity=2000, dump_level=logging.ERROR, path=None, record_size=256):
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.capacity = capacity
+        self.dump_level = dump_level
+        self.path = path
+        self._records = deque(maxlen=capacity)
+        self._ring = _MappedRing(path, capacity * record_size) if path else None
+
+    def emit(self, record):
+        if self._ring is None:
+            self._records.append(record)
+        else:
+            self._ring.append(self._encode(record)[-self._ring.size:])
+
+        if record.levelno >= self.dump_level:
+            self._dump()
+
+    def _encode(self, record):
+        """ Encode the fields of a record needed to rebuild it into a single line.
+        """
+        message = record.getMessage()
+
+        if record.exc_info:
+            message += '\n' + logging.Formatter().formatException(record.exc_info)
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        return '{0!r}\t{1}\t{2}\t{3}\n'.format(record.created, record.levelno, record.name,
+                                                message.encode('string_escape'))
+
+    @staticmethod
+    def _decode(line):
+        """ Rebuild a LogRecord from a line written by _encode.
+        """
+        created, levelno, name, message = line.split('\t', 3)
+        record = logging.LogRecord(name, int(levelno), __file__, 0, message.decode('string_escape'), None, None)
+        record.created = float(created)
+        record.msecs = (record.created - int(record.created)) * 1000
+        return record
+
+    def _buffered_records(self):
+        """ Return every buffered record, oldest first, and empty the buffer.
+        """
+        if self._ring is None:
+            records = list(self._records)
+            self._records.clear()
+            return records
+
+        records = []
+
+        for line in self._ring.read().splitlines():
+            try:
+                records.append(self._decode(line))
+            except ValueError:
+                # A line only partially written when the process died.
+                continue
+
+        self._ring.clear()
+        return records
+
+    @staticmethod
+    def _restamp(record, now, formatter):
+        """ Return a copy of a buffered record stamped with the time of the dump, its own time moving to its message.
+        """
+        dumped = logging.makeLogRecord(record.__dict__)
+        dumped.msg = '({0}.{1:03d}) {2}'.format(formatter.formatTime(record, '%Y-%m-%d %H:%M:%S'), int(record.msecs),
+                                               record.getMessage())
+        dumped.args = None
+        dumped.created = now
+        dumped.msecs = (now - int(now)) * 1000
+        dumped.relativeCreated = (now - logging._startTime) * 1000
+        return dumped
+
+    def _marker(self, name, message, now):
+        """ Return a record delimiting a dump.
+        """
+        record = logging.LogRecord(name, logging.INFO, __file__, 0, message, None, None)
+        record.created = now
+        record.msecs = (now - int(now)) * 1000
+        return record
+
+    def _dump(self):
+        """ Write the buffered records to every target whose level they are below, as a delimited block.
+        """
+        records = self._buffered_records()
+
+        if not records:
+            return
+
+        now = time.time()
+        formatter = logging.Formatter()
+        name = records[-1].name
+
+        for target in self.targets:
+            dumped = [self._restamp(record, now, formatter) for record in records if record.levelno < target.level]
+
+            if not dumped:
+                continue
+
+            target.handle(self._marker(name, 'Flight recorder dump begins: {0} records'.format(len(dumped)), now))
+
+            for record in dumped:
+                target.handle(record)
+
+            target.handle(self._marker(name, 'Flight recorder dump ends', now))
+            target.flush()
+
+    def dump(self):
+        """ Write out the buffered records now.
+        """
+        self.acquire()
+
+        try:
+            self._dump()
+        finally:
+            self.release()
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.clear()
+            self._ring.close()
+            self._ring = None
+
+        logging.Handler.close(self)
+
+
+class QueueHandler(logging.Handler):
+    """ Handler that only puts records on a queue, to be written by a QueueListener on another thread.
+
+    :param queue: The Queue.Queue to put records on.
+    :param overflow_policy: What to do when the queue is full, BLOCK until there is room,
+        DROP_OLDEST to discard the oldest queued record, or DROP_NEW to discard the new record.
+    """
+
+    def __init__(self, queue, overflow_policy=BLOCK):
+        if overflow_policy not in (BLOCK, DROP_OLDEST, DROP_NEW):
+            raise ValueError('Unknown overflow policy: {0}'.format(overflow_policy))
+
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+
+    @staticmethod
+    def prepare(record):
+        """ Merge the message arguments and exception text into the record, so it is safe to pass to another thread
+            even if the arguments are modified afterwards.
+
+            :param record: The LogRecord to prepare.
+            :return: The prepared LogRecord.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        """ Put the record on our queue, applying our overflow policy if it is full.
+
+            :param record: The LogRecord to queue.
+        """
+        if self.overflow_policy == BLOCK:
+            self.queue.put(record)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except Queue.Full:
+                self.dropped += 1
+
+                if self.overflow_policy == DROP_NEW:
+                    return
+
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+    def emit(self, record):
+        try:
+            self.enqueue(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """ Background thread that takes records off a queue and passes them to the given handlers.
+
+        stop queues a sentinel record behind the waiting ones. A QueueHandler dropping the oldest records of a full
+        queue can drop the sentinel too, so the thread also exits once it has handled as many records as were waiting
+        when stop was called, and stop keeps queueing the sentinel in case the thread is waiting for a record.
+
+    :param queue: The Queue.Queue to take records from.
+    :param handlers: The handlers to write each record with.
+    """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+        self._stopping = threading.Event()
+        self._backlog = 0
+
+    def start(self):
+        """ Start the background thread.
+        """
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        """ Pass a record to each of our handlers whose level it meets.
+
+            :param record: The LogRecord to handle.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        """ Target of the background thread, handle records until we are stopping and either a sentinel is received
+            or the records waiting when stop was called have been handled.
+        """
+        while True:
+            record = self.queue.get()
+
+            if record is self._sentinel:
+                if self._stopping.is_set():
+                    break
+
+                # Left over from an earlier stop.
+                continue
+
+            self.handle(record)
+
+            if self._stopping.is_set():
+                self._backlog -= 1
+
+                if self._backlog < 0:
+                    break
+
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        """ Stop the background thread, once every record queued before this call has been handled.
+        """
+        if not self._thread:
+            return
+
+        self._backlog = self.queue.qsize()
+        self._stopping.set()
+
+        while self._thread.is_alive():
+            try:
+                self.queue.put(self._sentinel, timeout=STOP_RETRY_INTERVAL)
+            except Queue.Full:
+                continue
+
+            self._thread.join(STOP_RETRY_INTERVAL)
+
+        self._thread = None
+
+
+class AggregatingHandler(logging.Handler):
+    """ Handler that sends records in batches to the LogAggregator of another process, which owns the log file.
+
+        Batches are sent once batch_size records are waiting, or every flush_interval seconds.
+        A batch that cannot be sent, even after reconnecting, is dropped and counted in dropped,
+        as is a record that cannot be pickled (such as one with an unpicklable extra field).
+
+    :param address: The multiprocessing.connection address of the LogAggregator.
+    :param batch_size: The number of records to send at once.
+    :param flush_interval: The maximum number of seconds a record waits before being sent.
+    :param authkey: The key to authenticate to the LogAggregator with.
+    """
+
+    def __init__(self, address, batch_size=256, flush_interval=0.5, authkey=None):
+        logging.Handler.__init__(self)
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._batch = []
+        self._connection = None
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def emit(self, record):
+        try:
+            self._batch.append(QueueHandler.prepare(record).__dict__)
+
+            if len(self._batch) >= self.batch_size:
+                self._send()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _send(self):
+        """ Send the waiting records, reconnecting once if the connection was lost.
+        """
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        data = self._pickle(batch)
+
+        for _ in xrange(2):
+            try:
+                if self._connection is None:
+                    self._connection = Client(self.address, authkey=self.authkey)
+
+                self._connection.send_bytes(data)
+                return
+            except (EOFError, IOError, socket.error, AuthenticationError):
+                self._disconnect()
+
+        self.dropped += len(batch)
+
+    def _pickle(self, batch):
+        """ Pickle a batch of records, leaving out (and counting) the records that cannot be pickled.
+        """
+        try:
+            return cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            picklable = []
+
+            for attributes in batch:
+                try:
+                    cPickle.dumps(attributes, cPickle.HIGHEST_PROTOCOL)
+                    picklable.append(attributes)
+                except Exception:
+                    self.dropped += 1
+
+            return cPickle.dumps(picklable, cPickle.HIGHEST_PROTOCOL)
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _flush_periodically(self):
+        """ Target of the flush thread, send the waiting records every flush_interval seconds until closed.
+        """
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+
+        try:
+            self._send()
+        finally:
+            self.release()
+
+    def close(self):
+        self._closed.set()
+
+        if self._flusher is not threading.current_thread():
+            self._flusher.join()
+
+        self.acquire()
+
+        try:
+            self._send()
+            self._disconnect()
+        finally:
+            self.release()
+
+        logging.Handler.close(self)
+
+
+class LogAggregator(object):
+    """ Background threads that receive batches of records from AggregatingHandlers in other processes
+        and pass them to the given handlers, so a single process writes (and rotates) the log file.
+
+        Records are unpickled, so every connection must first authenticate with authkey. This is done on its
+        receiving thread rather than by the listener, so a peer that never answers does not block the others.
+
+    :param listener: The multiprocessing.connection.Listener to accept connections on, without an authkey.
+    :param authkey: The key connections must authenticate with.
+    :param handlers: The handlers to write each record with.
+    """
+
+    def __init__(self, listener, authkey, *handlers):
+        self.listener = listener
+        self.authkey = authkey
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        """ Start accepting connections.
+        """
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        """ Target of the accept thread, start a receiving thread for every connection until stopped.
+        """
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (EOFError, IOError, socket.error):
+                if self._thread is None:
+                    return
+
+                continue
+
+            receiver = threading.Thread(target=self._receive, args=(connection,))
+            receiver.daemon = True
+            receiver.start()
+
+    def _receive(self, connection):
+        """ Target of a receiving thread, handle every batch sent on the connection until it is closed.
+        """
+        try:
+            deliver_challenge(connection, self.authkey)
+            answer_challenge(connection, self.authkey)
+
+            while self._thread is not None:
+                for attributes in cPickle.loads(connection.recv_bytes()):
+                    self.handle(logging.makeLogRecord(attributes))
+        except (EOFError, IOError, AuthenticationError):
+            pass
+        finally:
+            connection.close()
+
+    def handle(self, record):
+        """ Pass a record to each of our handlers whose level it meets.
+
+            :param record: The LogRecord to handle.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        """ Stop accepting connections and flush our handlers.
+        """
+        if not self._thread:
+            return
+
+        self._thread = None
+        self.listener.close()
+
+        for handler in self.handlers:
+            handler.flush()
+
+
+class BufferedRotatingFileHandler(logging.Handler):
+    """ Rotating file handler that buffers formatted records in memory, and leaves all disk work to background threads.
+
+        The buffer is written out by a writer thread once it holds buffer_size bytes, every flush_interval seconds,
+        or as soon as a record at flush_level or above is logged. The writer thread also rotates the file once it
+        would grow past max_bytes, and the rotated files are gzipped (to filename.1.gz, filename.2.gz, ...)
+        by a separate compression thread, keeping backup_count of them.
+
+    :param filename: The path to the log file.
+    :param max_bytes: The size the log file is rotated at, 0 to never rotate.
+    :param backup_count: The number of rotated log files to keep.
+    :param buffer_size: The number of buffered bytes that triggers a write.
+    :param flush_interval: The maximum time, in seconds, records stay buffered.
+    :param flush_level: Records at or above this level trigger an immediate write.
+    :param compress: Whether to gzip rotated log files.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=2, buffer_size=64 * 1024, flush_interval=1.0,
+                 flush_level=logging.ERROR, compress=True):
+        logging.Handler.__init__(self)
+        self.baseFilename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.compress = compress
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._rotation_count = 0
+
+        self._stream = open(self.baseFilename, 'a')
+        self._size = os.path.getsize(self.baseFilename)
+
+        self._compress_queue = Queue.Queue()
+        self._compressor = threading.Thread(target=self._compress_backups)
+        self._compressor.daemon = True
+        self._compressor.start()
+
+        self._writer = threading.Thread(target=self._write_buffer)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + '\n'
+
+            # Encode here, as StreamHandler does, so a unicode message never reaches the writer thread.
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self._condition:
+            self._buffer.append(line)
+            self._buffered_bytes += len(line)
+
+            if self._buffered_bytes >= self.buffer_size or record.levelno >= self.flush_level:
+                self._flush_requested = True
+                self._condition.notify()
+
+    def flush(self):
+        """ Write out every buffered record now, on the calling thread.
+        """
+        self._flush_buffer()
+
+    def close(self):
+        """ Write out every buffered record, stop the background threads, and close the log file.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        if self._writer.is_alive():
+            self._writer.join()
+
+        self._compress_queue.put(None)
+
+        if self._compressor.is_alive():
+            self._compressor.join()
+
+        logging.Handler.close(self)
+
+    def _write_buffer(self):
+        """ Target of the writer thread, write out the buffer whenever a write is requested or the interval passes.
+        """
+        while True:
+            with self._condition:
+                if not self._flush_requested and not self._closed:
+                    self._condition.wait(self.flush_interval)
+
+                closed = self._closed
+
+            try:
+                self._flush_buffer()
+            except Exception:
+                self._handle_background_error('Writing to {0} failed'.format(self.baseFilename))
+
+            if closed:
+                break
+
+        with self._write_lock:
+            self._stream.close()
+
+    def _flush_buffer(self):
+        """ Take every buffered record and write it to the log file, rotating it first if it would grow too big.
+            Writes are serialized through our write lock so the records stay in order.
+        """
+        with self._write_lock:
+            with self._condition:
+                lines = self._buffer
+                self._buffer = []
+                self._buffered_bytes = 0
+                self._flush_requested = False
+
+            if not lines or self._stream.closed:
+                return
+
+            data = ''.join(lines)
+
+            if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+
+            self._stream.write(data)
+            self._stream.flush()
+            self._size += len(data)
+
+    def _handle_background_error(self, message):
+        """ Report an error of one of our background threads through handleError, which needs a record.
+        """
+        self.handleError(logging.makeLogRecord({'msg': message, 'levelno': logging.ERROR, 'levelname': 'ERROR'}))
+
+    def _backup_path(self, index, extension=''):
+        return '{0}.{1}{2}'.format(self.baseFilename, index, extension)
+
+    def _shift_backups(self, extension):
+        """ Shift every rotated log file up by one index, dropping the oldest beyond our backup count.
+        """
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self._backup_path(index, extension)
+            destination = self._backup_path(index + 1, extension)
+
+            if os.path.exists(source):
+                if os.path.exists(destination):
+                    os.remove(destination)
+
+                os.rename(source, destination)
+
+        if os.path.exists(self._backup_path(1, extension)):
+            os.remove(self._backup_path(1, extension))
+
+    def _rotate(self):
+        """ Move the current log file aside and start a new one. Only a rename is done here,
+            compressing the rotated file and shifting the older ones is left to the compression thread.
+        """
+        self._stream.close()
+
+        if self.backup_count > 0:
+            if self.compress:
+                self._rotation_count += 1
+                rotated_path = '{0}.rotated-{1}'.format(self.baseFilename, self._rotation_count)
+                os.rename(self.baseFilename, rotated_path)
+                self._compress_queue.put(rotated_path)
+            else:
+                self._shift_backups('')
+                os.rename(self.baseFilename, self._backup_path(1))
+
+        self._stream = open(self.baseFilename, 'w')
+        self._size = 0
+
+    def _compress_backups(self):
+        """ Target of the compression thread, gzip each rotated log file into filename.1.gz, shifting the older ones.
+        """
+        while True:
+            rotated_path = self._compress_queue.get()
+
+            if rotated_path is None:
+                return
+
+            compressed_path = self._backup_path(1, '.gz')
+            temporary_path = compressed_path + '.tmp'
+
+            try:
+                with open(rotated_path, 'rb') as rotated_file:
+                    with gzip.open(temporary_path, 'wb') as compressed_file:
+                        shutil.copyfileobj(rotated_file, compressed_file)
+
+                self._shift_backups('.gz')
+                os.rename(temporary_path, compressed_path)
+                os.remove(rotated_path)
+            except Exception:
+                self._handle_background_error('Compressing {0} failed'.format(rotated_path))
+
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+
+
+class LogReader(object):
+    """ Read the records of a log file written by initialize, across its rotated (and gzipped) files.
+
+        Files are read oldest first (filepath.N down to filepath.1, then filepath), assuming records within them
+        are in chronological order. Uncompressed files get a sparse index of (time, offset) pairs, sampled every
+        index_interval bytes without reading the rest of the file, so time-range queries seek straight to the
+        first matching records. Gzipped files cannot be seeked cheaply, so they are only skipped when the time range
+        excludes them entirely. Lines that do not start a record (such as exception tracebacks) belong to the
+        record before them.
+
+    :param filepath: The path to the log file.
+    :param structured: Whether the files are JSON lines (see JsonFormatter), None to detect it from the first line.
+    :param index_interval: The number of bytes between the points of a file's time index.
+    """
+    _header = re.compile(r'\[(.*)\]\[([A-Z]+)-(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\]: (.*)$')
+    _time_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, filepath, structured=None, index_interval=64 * 1024):
+        self.filepath = os.path.abspath(filepath)
+        self.structured = structured
+        self.index_interval = index_interval
+        self._indexes = {}
+        self._cached_time = (None, None)
+
+    def files(self):
+        """ Return the paths of the rotation set of our log file that exist, oldest first.
+            This includes the filepath.rotated-N files BufferedRotatingFileHandler leaves until it has compressed
+            them, which are newer than every numbered backup.
+        """
+        directory, base_name = os.path.split(self.filepath)
+        pattern = re.compile(re.escape(base_name) + r'\.(\d+)(\.gz)?$')
+        pending_pattern = re.compile(re.escape(base_name) + r'\.rotated-(\d+)$')
+        backups = []
+        pending = []
+
+        for file_name in os.listdir(directory):
+            match = pattern.match(file_name)
+
+            if match:
+                backups.append((int(match.group(1)), os.path.join(directory, file_name)))
+                continue
+
+            match = pending_pattern.match(file_name)
+
+            if match:
+                pending.append((int(match.group(1)), os.path.join(directory, file_name)))
+
+        paths = [path for _, path in sorted(backups, reverse=True)]
+        paths.extend(path for _, path in sorted(pending))
+
+        if os.path.exists(self.filepath):
+            paths.append(self.filepath)
+
+        return paths
+
+    def _parse_time(self, text):
+        """ Return the epoch time of a formatted time, the last one parsed is cached as lines come in order.
+        """
+        if text != self._cached_time[0]:
+            self._cached_time = (text, time.mktime(time.strptime(text, self._time_format)))
+
+        return self._cached_time[1]
+
+    def _parse_line(self, line):
+        """ Return the LogEntry started by the given line, or None if it continues the previous record.
+        """
+        line = line.rstrip('\r\n')
+
+        if self.structured is None:
+            self.structured = line.startswith('{')
+
+        if self.structured:
+            try:
+                fields = json.loads(line)
+            except ValueError:
+                return None
+
+            message = fields.get('message', '')
+
+            if 'exception' in fields:
+                message += '\n' + fields['exception']
+
+            return LogEntry(fields.get('timestamp'), logging.getLevelName(fields.get('level')),
+                            fields.get('logger'), message)
+
+        match = self._header.match(line)
+
+        if not match:
+            return None
+
+        name, level_name, time_text, message = match.groups()
+        return LogEntry(self._parse_time(time_text), logging.getLevelName(level_name), name, message)
+
+    def _parse(self, lines, previous=None):
+        """ Yield the records of the given lines, appending continuation lines to the record before them.
+
+            :param lines: The lines to parse.
+            :param previous: The record before the lines, that leading continuation lines belong to.
+        """
+        pending = None
+
+        for line in lines:
+            entry = self._parse_line(line)
+
+            if entry is not None:
+                if pending is not None:
+                    yield pending
+
+                pending = entry
+            elif pending is not None:
+                pending = pending._replace(message=pending.message + '\n' + line.rstrip('\r\n'))
+            elif previous is not None:
+                pending = previous._replace(message=line.rstrip('\r\n'))
+
+        if pending is not None:
+            yield pending
+
+    def _index(self, path):
+        """ Return the sparse (times, offsets) index of an uncompressed file, rebuilding it when the file changed.
+        """
+        status = os.stat(path)
+        signature = (status.st_ino, status.st_size, status.st_mtime)
+        cached = self._indexes.get(path)
+
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        times = []
+        offsets = []
+
+        with open(path, 'rb') as log_file:
+            for offset in xrange(0, status.st_size, self.index_interval):
+                if offsets and offsets[-1] >= offset:
+                    continue
+
+                log_file.seek(offset)
+
+                if offset:
+                    log_file.readline()
+
+                while True:
+                    position = log_file.tell()
+                    line = log_file.readline()
+
+                    if not line:
+                        break
+
+                    entry = self._parse_line(line)
+
+                    if entry is not None:
+                        times.append(entry.time)
+                        offsets.append(position)
+                        break
+
+        index = (times, offsets)
+        self._indexes[path] = (signature, index)
+        return index
+
+    def _first_time(self, path):
+        """ Return the time of the first record of a file, or None if it has none.
+        """
+        if not path.endswith('.gz'):
+            times = self._index(path)[0]
+            return times[0] if times else None
+
+        with gzip.open(path, 'rb') as log_file:
+            for line in log_file:
+                entry = self._parse_line(line)
+
+                if entry is not None:
+                    return entry.time
+
+        return None
+
+    @staticmethod
+    def _to_epoch(value):
+        if isinstance(value, datetime.datetime):
+            return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+        return value
+
+    @staticmethod
+    def _matcher(level, names):
+        """ Return a function testing whether a LogEntry passes the level and logger filters, or None for no filter.
+        """
+        if level is None and not names:
+            return None
+
+        if isinstance(names, basestring):
+            names = [names]
+
+        prefixes = tuple(name + '.' for name in names or ())
+        names = frozenset(names or ())
+
+        def matches(entry):
+            if level is not None and entry.level < level:
+                return False
+
+            return not names or entry.name in names or entry.name.startswith(prefixes)
+
+        return matches
+
+    def _read_file(self, path, start):
+        """ Yield the records of a file, seeking close to the start time if the file has an index.
+        """
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rb') as log_file:
+                for entry in self._parse(log_file):
+                    yield entry
+            return
+
+        offset = 0
+
+        if start is not None:
+            times, offsets = self._index(path)
+            position = bisect.bisect_left(times, start) - 1
+
+            if position > 0:
+                offset = offsets[position]
+
+        with open(path, 'rb') as log_file:
+            log_file.seek(offset)
+
+            for entry in self._parse(log_file):
+                yield entry
+
+    def entries(self, start=None, end=None, level=None, names=None):
+        """ Yield the records of the rotation set, oldest first.
+
+            :param start: Only yield records at or after this time (epoch seconds or a datetime).
+            :param end: Only yield records before this time (epoch seconds or a datetime).
+            :param level: Only yield records at or above this level.
+            :param names: Only yield records of these loggers (a name or a list of names), or their children.
+        """
+        start = self._to_epoch(start)
+        end = self._to_epoch(end)
+        matches = self._matcher(level, names)
+        paths = self.files()
+        first_times = [self._first_time(path) for path in paths] if start is not None or end is not None else None
+
+        for position, path in enumerate(paths):
+            if first_times is not None:
+                next_time = first_times[position + 1] if position + 1 < len(paths) else None
+
+                # Records of the same second may straddle a rotation, so a file is only skipped when
+                # the next one starts strictly before start.
+                if start is not None and next_time is not None and next_time < start:
+                    continue
+
+                if end is not None and first_times[position] is not None and first_times[position] >= end:
+                    return
+
+            for entry in self._read_file(path, start):
+                if start is not None and entry.time < start:
+                    continue
+
+                if end is not None and entry.time >= end:
+                    return
+
+                if matches is None or matches(entry):
+                    yield entry
+
+    def _tail_offset(self, log_map, count):
+        """ Return the offset of the count-th last line start of a mapped file.
+        """
+        offset = len(log_map)
+
+        if offset and log_map[offset - 1] == '\n':
+            offset -= 1
+
+        for _ in xrange(count):
+            offset = log_map.rfind('\n', 0, offset)
+
+            if offset < 0:
+                return 0
+
+        return offset + 1
+
+    @staticmethod
+    def _read_appended(log_file, offset, to_end=False):
+        """ Read the lines appended to a file since the given offset, mapping only the pages holding new bytes.
+
+            :param log_file: The open file to read.
+            :param offset: The offset the previous read stopped at.
+            :param to_end: Whether to also read a trailing incomplete line, instead of waiting for the rest of it.
+            :return: A (lines, offset) tuple of the new lines and the offset to read from next.
+        """
+        size = os.fstat(log_file.fileno()).st_size
+
+        if size <= offset:
+            return [], offset
+
+        map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        log_map = mmap.mmap(log_file.fileno(), size - map_offset, access=mmap.ACCESS_READ, offset=map_offset)
+
+        try:
+            line_end = size - map_offset if to_end else log_map.rfind('\n', offset - map_offset) + 1
+
+            if line_end <= offset - map_offset:
+                return [], offset
+
+            return log_map[offset - map_offset:line_end].splitlines(True), map_offset + line_end
+        finally:
+            log_map.close()
+
+    def follow(self, backlog=10, level=None, names=None, poll_interval=0.5):
+        """ Yield the last records of the log file, then every record appended to it, forever.
+
+            Only the bytes appended since the last poll are mapped and parsed. Once the file is rotated, the rest of
+            the old file is read before the new one is followed from its start, which also happens on truncation.
+
+            :param backlog: The number of lines at the end of the file to yield records from first.
+            :param level: Only yield records at or above this level.
+            :param names: Only yield records of these loggers (a name or a list of names), or their children.
+            :param poll_interval: The number of seconds between checks for new records.
+        """
+        matches = self._matcher(level, names)
+        log_file = None
+        inode = None
+        offset = 0
+        previous = None
+
+        try:
+            while True:
+                lines = []
+
+                try:
+                    status = os.stat(self.filepath)
+                except OSError:
+                    status = None
+
+                if status is not None and (status.st_ino != inode or status.st_size < offset):
+                    if log_file is not None:
+                        if status.st_ino != inode:
+                            lines, offset = self._read_appended(log_file, offset, to_end=True)
+
+                        log_file.close()
+
+                    log_file = open(self.filepath, 'rb')
+                    inode = os.fstat(log_file.fileno()).st_ino
+                    offset = 0
+
+                    if backlog and status.st_size:
+                        log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+                        try:
+                            offset = self._tail_offset(log_map, backlog)
+                        finally:
+                            log_map.close()
+
+                    # The backlog only applies to the file being followed when we start.
+                    backlog = 0
+
+                if log_file is not None:
+                    new_lines, offset = self._read_appended(log_file, offset)
+                    lines.extend(new_lines)
+
+                for entry in self._parse(lines, previous):
+                    previous = entry
+
+                    if matches is None or matches(entry):
+                        yield entry
+
+                time.sleep(poll_interval)
+        finally:
+            if log_file is not None:
+                log_file.close()
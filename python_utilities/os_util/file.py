@@ -9,6 +9,7 @@ import glob
 import hashlib
 import os
 import shutil
+import tempfile
 
 import exceptions
 import path
@@ -176,6 +177,42 @@ def change_working_directory(filepath):
     os.chdir(current_directory)
 
 
+@contextmanager
+def atomic_write(filepath, mode='wb'):
+    """ Context manager to write a file atomically, the data is written to a temporary file in the same directory,
+        which replaces filepath only once it has been fully written and synced to disk.
+
+    :param filepath: The path of the file to write.
+    :param mode: The mode to open the temporary file with.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(filepath), suffix='.tmp', dir=directory)
+
+    try:
+        with os.fdopen(file_descriptor, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, temp_path)
+
+            if windows_platform():
+                # os.rename will not overwrite an existing file on NT based systems.
+                os.remove(filepath)
+        else:
+            # mkstemp creates the file readable only by us, give it the permissions a new file normally gets.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+
+        os.rename(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def md5(filename, block_size=256 * 128):
     """ Return the MD5 checksum value for the given file.
 
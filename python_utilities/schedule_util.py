@@ -1,15 +1,267 @@
 # coding=utf-8
-""" Convenience wrappers for SchedulingJobs using pyqt QTimers.
+""" Convenience wrappers for SchedulingJobs, driven by pyqt QTimers, a background thread or an asyncio event loop.
 
 Author: Ian Davis
 """
 
-from datetime import datetime
+import cPickle
+import calendar
+import heapq
+import logging
+import os
+import random
+import select
+import socket
+import sqlite3
+import threading
+import time as time_
 
-from Pyqt4.QtCore import QTimer
+try:
+    from PyQt4.QtCore import QTimer
+except ImportError:
+    QTimer = None
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from collections import deque, namedtuple
+from datetime import datetime, timedelta, time as datetime_time
+
+from python_utilities import os_util
 
 SECOND = 1000
 MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+
+# The longest the scheduler timer sleeps for, so it catches up with changes to the system clock.
+MAXIMUM_SLEEP = HOUR
+
+# Misfire policies of a ScheduledJob, for runs missed by more than MISFIRE_GRACE_TIME (such as while the process
+# was down): run the job once, run it once for every missed run, or skip the missed runs.
+RUN_ONCE = 'run-once'
+RUN_ALL = 'run-all'
+SKIP = 'skip'
+
+MISFIRE_GRACE_TIME = MINUTE
+
+# How long ThreadingBackend waits before calling a callback that raised again, unless it re-armed itself.
+CALLBACK_RETRY_DELAY = 5 * SECOND
+
+# Statistics of a job kept by SchedulerMetrics, times are in seconds since the epoch and durations in seconds.
+JobStatistics = namedtuple('JobStatistics', 'runs failures skipped last_scheduled last_started last_lateness '
+                                            'max_lateness mean_lateness last_duration max_duration mean_duration')
+
+_WEEKDAYS = dict((name.lower(), index) for index, name in enumerate(calendar.day_name))
+
+_MONTH_NAMES = dict((name.lower(), index) for index, name in enumerate(calendar.month_abbr) if name)
+_DAY_NAMES = dict((name.lower(), (index + 1) % 7) for index, name in enumerate(calendar.day_abbr))
+
+# The number of years after which a cron expression that has not matched is considered to never match.
+_CRON_SEARCH_YEARS = 28
+
+
+def _parse_time(text):
+    """ Parse a '%H:%M' or '%H:%M:%S' time of day, without the overhead of strptime.
+
+        :param text: The time to parse.
+        :raise ValueError: If the time is not in either format.
+        :return: The parsed time, as a datetime.time.
+    """
+    fields = text.split(':')
+
+    if not 2 <= len(fields) <= 3:
+        raise ValueError('Invalid time of day: {0}'.format(text))
+
+    return datetime_time(*[int(field) for field in fields])
+
+
+def _next_bit(mask, value):
+    """ Return the smallest set bit of mask at or above value, or None if there is none.
+    """
+    remaining = mask >> value
+
+    if not remaining:
+        return None
+
+    return value + (remaining & -remaining).bit_length() - 1
+
+
+class CronExpression(object):
+    """ A cron style schedule, compiled once into a bitset per field so finding the next run only takes
+        a few bit operations per field instead of testing every second.
+
+        Takes the usual five fields (minute, hour, day of month, month, day of week), or six with a leading
+        seconds field. Fields accept *, numbers, names (jan, mon), ranges, lists and steps (*/15, 1-10/2).
+        As in cron, a job restricted on both day fields runs on days matching either of them.
+
+    :param expression: The cron expression.
+    :raise ValueError: If the expression is invalid.
+    """
+    # (minimum, maximum, names) of each field.
+    _fields = ((0, 59, None), (0, 59, None), (0, 23, None), (1, 31, None), (1, 12, _MONTH_NAMES), (0, 7, _DAY_NAMES))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+
+        if len(fields) == 5:
+            fields.insert(0, '0')
+        elif len(fields) != 6:
+            raise ValueError('A cron expression needs 5 or 6 fields: {0}'.format(expression))
+
+        masks = [self._compile(field, *limits) for field, limits in zip(fields, self._fields)]
+        self.seconds, self.minutes, self.hours, self.days, self.months, weekdays = masks
+
+        # Sunday may be given as 0 or 7, cron numbers weekdays from sunday while datetime does from monday.
+        weekdays = (weekdays | weekdays >> 7) & 0x7f
+        self.weekdays = (weekdays >> 1) | ((weekdays & 1) << 6)
+
+        self.any_day = fields[3] == '*'
+        self.any_weekday = fields[5] == '*'
+
+    def _key(self):
+        return (self.seconds, self.minutes, self.hours, self.days, self.months, self.weekdays, self.any_day,
+                self.any_weekday)
+
+    def __eq__(self, other):
+        return isinstance(other, CronExpression) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    @staticmethod
+    def _compile(field, minimum, maximum, names):
+        """ Compile a single field into a bitset of the values it matches.
+        """
+        mask = 0
+
+        for part in field.lower().split(','):
+            step = 1
+
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+
+            if part == '*':
+                start, stop = minimum, maximum
+            else:
+                bounds = [names[bound] if names and bound in names else int(bound) for bound in part.split('-')]
+                start, stop = bounds[0], bounds[-1] if len(bounds) > 1 or step == 1 else maximum
+
+            if not minimum <= start <= stop <= maximum or step < 1:
+                raise ValueError('Invalid cron field: {0}'.format(field))
+
+            for value in xrange(start, stop + 1, step):
+                mask |= 1 << value
+
+        return mask
+
+    def _day_matches(self, date):
+        day = self.days >> date.day & 1
+        weekday = self.weekdays >> date.weekday() & 1
+
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def next_run(self, after):
+        """ Return the first time strictly after the given one matching the expression.
+
+            :param after: The datetime to start from.
+            :raise ValueError: If the expression never matches.
+        """
+        candidate = after.replace(microsecond=0) + timedelta(seconds=1)
+        last_year = candidate.year + _CRON_SEARCH_YEARS
+
+        while candidate.year <= last_year:
+            month = _next_bit(self.months, candidate.month)
+
+            if month is None:
+                candidate = datetime(candidate.year + 1, 1, 1)
+                continue
+
+            if month != candidate.month:
+                candidate = datetime(candidate.year, month, 1)
+
+            if not self._day_matches(candidate):
+                candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+                continue
+
+            hour = _next_bit(self.hours, candidate.hour)
+
+            if hour is None:
+                candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+                continue
+
+            if hour != candidate.hour:
+                candidate = candidate.replace(hour=hour, minute=0, second=0)
+
+            minute = _next_bit(self.minutes, candidate.minute)
+
+            if minute is None:
+                candidate = candidate.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+
+            if minute != candidate.minute:
+                candidate = candidate.replace(minute=minute, second=0)
+
+            second = _next_bit(self.seconds, candidate.second)
+
+            if second is None:
+                candidate = candidate.replace(second=0) + timedelta(minutes=1)
+                continue
+
+            return candidate.replace(second=second)
+
+        raise ValueError('Cron expression never matches: {0}'.format(self.expression))
+
+
+class Interval(object):
+    """ A schedule repeating every fixed interval from a start time, the next run is computed directly.
+
+    :param interval: The interval, as a timedelta or a number of seconds.
+    :param start: The datetime the intervals are counted from (defaults to now).
+    """
+
+    def __init__(self, interval, start=None):
+        if not isinstance(interval, timedelta):
+            interval = timedelta(seconds=interval)
+
+        if interval <= timedelta(0):
+            raise ValueError('Interval must be positive: {0}'.format(interval))
+
+        self.interval = interval
+        self.start = start or datetime.now()
+        self._seconds = interval.total_seconds()
+
+    def __eq__(self, other):
+        return isinstance(other, Interval) and (self.interval, self.start) == (other.interval, other.start)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.interval, self.start))
+
+    def next_run(self, after):
+        """ Return the first run strictly after the given time.
+
+            :param after: The datetime to start from.
+        """
+        if after < self.start:
+            return self.start
+
+        elapsed = (after - self.start).total_seconds()
+        return self.start + timedelta(seconds=(int(elapsed // self._seconds) + 1) * self._seconds)
 
 
 class ScheduledJob(object):
@@ -17,66 +269,797 @@ class ScheduledJob(object):
 
     :param name: The name of the job.
     :param data: Any data pertaining to the job.
-    :param time: The time the job should start.
+    :param time: The time the job should start, as '%H:%M' or '%H:%M:%S'. With an interval frequency
+        it is the time of day the intervals are counted from, and it is ignored with a cron frequency.
     :param day: The day the job is scheduled for.
-    :param frequency: The frequency the job should repeat.
+    :param frequency: The frequency the job should repeat, DAILY (every day, ignoring day) or WEEKLY (only on the
+        given day), a cron expression (as a string or a CronExpression), or an interval (as a timedelta or an Interval).
+    :param misfire: What to do about missed runs, one of RUN_ONCE, RUN_ALL or SKIP.
+    :param jitter: The number of seconds each run may be delayed by at random, None to use the scheduler's.
     """
     DAILY = 1
     WEEKLY = 2
 
-    def __init__(self, name, data, time, day=None, frequency=None):
+    def __init__(self, name, data, time=None, day=None, frequency=None, misfire=RUN_ONCE, jitter=None):
+        if misfire not in (RUN_ONCE, RUN_ALL, SKIP):
+            raise ValueError('Unknown misfire policy: {0}'.format(misfire))
+
         self.name = name
         self.data = data
-        self.time = datetime.strptime(time, '%H:%M')
-        self.day = day.lower()
+        self.misfire = misfire
+        self.jitter = jitter
+        self.last_run = None
+        self.time = _parse_time(time) if time else None
+        self.day = day.lower() if day else None
+        self.weekday = _WEEKDAYS[self.day] if self.day else None
         self.frequency = frequency
+        self.schedule = self._compile_frequency(frequency)
+
+        if self.schedule is None and self.time is None:
+            raise ValueError('Job {0} needs a time or a cron or interval frequency'.format(name))
+
+        self.next_run = self.compute_next_run()
+
+    def __getstate__(self):
+        # The runs are stored separately by a JobStore, and plain tuples unpickle much faster than datetimes.
+        state = dict(self.__dict__, next_run=None, last_run=None)
+
+        if self.time is not None:
+            state['time'] = (self.time.hour, self.time.minute, self.time.second)
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        if self.time is not None:
+            self.time = datetime_time(*self.time)
+
+    def same_schedule(self, other):
+        """ Return whether another job runs on the same schedule as this one.
+        """
+        return (self.time, self.day, self.frequency, self.misfire) == \
+            (other.time, other.day, other.frequency, other.misfire)
+
+    def _compile_frequency(self, frequency):
+        """ Return the CronExpression or Interval for our frequency, or None for a time of day schedule.
+        """
+        if isinstance(frequency, basestring):
+            return CronExpression(frequency)
+
+        if isinstance(frequency, timedelta):
+            start = None
+
+            if self.time is not None:
+                start = datetime.combine(datetime.now().date(), self.time)
+
+            return Interval(frequency, start=start)
+
+        if isinstance(frequency, (CronExpression, Interval)):
+            return frequency
+
+        return None
+
+    def compute_next_run(self, after=None):
+        """ Compute the first time after the given one that the job should execute.
+
+            :param after: The datetime to start from (defaults to now).
+            :return: The datetime of the next run.
+        """
+        after = after or datetime.now()
+
+        if self.schedule is not None:
+            return self.schedule.next_run(after)
+
+        candidate = after.replace(hour=self.time.hour, minute=self.time.minute, second=self.time.second,
+                                  microsecond=0)
+
+        if candidate <= after:
+            candidate += timedelta(days=1)
+
+        if self.weekday is not None and self.frequency != self.DAILY:
+            candidate += timedelta(days=(self.weekday - candidate.weekday()) % 7)
+
+        return candidate
+
+    def next_timestamp(self):
+        """ Return the time of the next run, in seconds since the epoch.
+        """
+        return time_.mktime(self.next_run.timetuple()) + self.next_run.microsecond / 1e6
 
     def ready(self):
         """ Method to determine whether or not the job should be executed now.
 
         :return: True or False to determine if the job should be executed now.
         """
-        current_date = datetime.now()
-        current_day = current_date.strftime('%A').lower()
+        return self.next_run <= datetime.now()
 
-        if self.day and not current_day == self.day:
-            return False
-        elif not current_date.hour == self.time.hour:
-            return False
-        elif not current_date.minute == self.time.minute:
-            return False
 
-        return True
+class QtTimerBackend(object):
+    """ Scheduler backend firing from a single shot QTimer, on the thread running the Qt event loop.
+    """
+
+    def __init__(self):
+        if QTimer is None:
+            raise OSError('Python module PyQt4 is not available on this system!')
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+
+    def start(self, callback):
+        """ Connect the callback to call whenever the timer fires.
+
+            :param callback: The function to call.
+        """
+        self.timer.timeout.connect(callback)
+
+    def arm(self, delay):
+        """ Fire once after the given delay, replacing any previous one.
+
+            :param delay: The delay in milliseconds.
+        """
+        self.timer.start(delay)
+
+    def stop(self):
+        """ Cancel the pending fire, if any.
+        """
+        self.timer.stop()
+
+    def close(self):
+        self.stop()
+
+
+def _socketpair():
+    """ Return a pair of connected sockets, through a localhost TCP connection where socket.socketpair is missing
+        (on Windows, where select only accepts sockets).
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server = listener.accept()[0]
+    finally:
+        listener.close()
+
+    return server, client
+
+
+class ThreadingBackend(object):
+    """ Scheduler backend firing from a background thread, for processes without an event loop.
+
+        The thread sleeps in select on a socket pair until the deadline, and arm or stop write to it to wake it up
+        to the new deadline. Unlike the timed waits of threading.Condition on python 2, which wake up every
+        50 milliseconds, this costs nothing while idle.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deadline = None
+        self._closed = False
+        self._callback = None
+        self._thread = None
+        self._wakeup_read, self._wakeup_write = _socketpair()
+        self._wakeup_write.setblocking(False)
+
+    def start(self, callback):
+        """ Start the background thread that calls the callback whenever the timer fires.
+
+            :param callback: The function to call.
+        """
+        self._callback = callback
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b'.')
+        except socket.error:
+            # The buffer is full of wake ups the thread has yet to read, one more is not needed.
+            pass
+
+    def arm(self, delay):
+        """ Fire once after the given delay, replacing any previous one.
+
+            :param delay: The delay in milliseconds.
+        """
+        with self._lock:
+            self._deadline = time_.time() + float(delay) / SECOND
+
+        self._wake()
+
+    def stop(self):
+        """ Cancel the pending fire, if any.
+        """
+        with self._lock:
+            self._deadline = None
+
+        self._wake()
+
+    def close(self):
+        """ Stop the background thread.
+        """
+        with self._lock:
+            self._closed = True
+
+        self._wake()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+    def _run(self):
+        """ Target of the background thread, sleep until the deadline (or a wake up) and fire when it has passed.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+
+                deadline = self._deadline
+
+            timeout = None if deadline is None else deadline - time_.time()
+
+            if timeout is None or timeout > 0:
+                if select.select([self._wakeup_read], [], [], timeout)[0]:
+                    self._wakeup_read.recv(4096)
+                    continue
+
+            with self._lock:
+                if self._deadline is None or self._deadline > time_.time():
+                    continue
+
+                self._deadline = None
+
+            try:
+                self._callback()
+            except Exception:
+                logging.getLogger(__name__).exception('Scheduler timer callback failed')
+
+                with self._lock:
+                    # The callback may have failed before re-arming, try it again rather than never firing again.
+                    if self._deadline is None:
+                        self._deadline = time_.time() + float(CALLBACK_RETRY_DELAY) / SECOND
+
+
+class AsyncioBackend(object):
+    """ Scheduler backend firing from an asyncio (or trollius on python 2) event loop.
+        Jobs must be added from the thread running the loop.
+
+    :param loop: The event loop to use (defaults to the current event loop).
+    """
+
+    def __init__(self, loop=None):
+        if asyncio is None:
+            raise OSError('Python module asyncio (or trollius) is not available on this system!')
+
+        self.loop = loop or asyncio.get_event_loop()
+        self._callback = None
+        self._handle = None
+
+    def start(self, callback):
+        """ Set the callback to call whenever the timer fires.
+
+            :param callback: The function to call.
+        """
+        self._callback = callback
+
+    def arm(self, delay):
+        """ Fire once after the given delay, replacing any previous one.
+
+            :param delay: The delay in milliseconds.
+        """
+        self.stop()
+        self._handle = self.loop.call_later(float(delay) / SECOND, self._callback)
+
+    def stop(self):
+        """ Cancel the pending fire, if any.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def close(self):
+        self.stop()
+
+
+class JobStore(object):
+    """ SQLite backed storage of scheduled jobs, with the time of their last and next runs.
+
+        Jobs are pickled, so their data must be picklable. Changes are kept in memory and written in a single
+        transaction once batch_size of them are waiting, or once the oldest of them has waited flush_interval
+        seconds, a Scheduler arms its timer for flush_deadline so this happens even while it is idle.
+
+    :param path: The path to the database file.
+    :param batch_size: The number of changes that triggers a write.
+    :param flush_interval: The maximum time, in seconds, a change waits before being written.
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._saved = {}
+        self._runs = {}
+        self._first_change = None
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                '(name BLOB PRIMARY KEY, job BLOB NOT NULL, last_run REAL, next_run REAL)')
+        self.connection.commit()
+
+    @staticmethod
+    def _key(name):
+        return sqlite3.Binary(cPickle.dumps(name, cPickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _timestamp(value):
+        return time_.mktime(value.timetuple()) + value.microsecond / 1e6 if value else None
+
+    def load(self):
+        """ Return every stored job, with the last and next runs they had when last written.
+        """
+        jobs = []
+
+        for job, last_run, next_run in self.connection.execute('SELECT job, last_run, next_run FROM jobs'):
+            job = cPickle.loads(str(job))
+            job.last_run = datetime.fromtimestamp(last_run) if last_run is not None else None
+            job.next_run = datetime.fromtimestamp(next_run)
+            jobs.append(job)
+
+        return jobs
+
+    def save(self, job):
+        """ Store a new or changed job.
+
+            :param job: The ScheduledJob to store.
+        """
+        self._saved[job.name] = job
+        self._runs.pop(job.name, None)
+        self._changed()
+
+    def delete(self, name):
+        """ Remove a job from the store.
+
+            :param name: The name of the job to remove.
+        """
+        self._saved[name] = None
+        self._runs.pop(name, None)
+        self._changed()
+
+    def record_run(self, job):
+        """ Store the last and next runs of a job that was just started.
+
+            :param job: The ScheduledJob that was started.
+        """
+        if job.name in self._saved:
+            return
+
+        self._runs[job.name] = (self._timestamp(job.last_run), self._timestamp(job.next_run))
+        self._changed()
+
+    def _changed(self):
+        if self._first_change is None:
+            self._first_change = time_.time()
+
+        self.maybe_flush()
+
+    @property
+    def flush_deadline(self):
+        """ The time the waiting changes must be written by, None if there are none.
+        """
+        if self._first_change is None:
+            return None
+
+        return self._first_change + self.flush_interval
+
+    def maybe_flush(self):
+        """ Write the waiting changes if batch_size of them are waiting or their flush deadline has passed.
+        """
+        if len(self._saved) + len(self._runs) >= self.batch_size or \
+                self._first_change is not None and time_.time() >= self.flush_deadline:
+            self.flush()
+
+    def flush(self):
+        """ Write every waiting change in a single transaction.
+        """
+        self._first_change = None
+
+        if not self._saved and not self._runs:
+            return
+
+        saved = [(self._key(name), sqlite3.Binary(cPickle.dumps(job, cPickle.HIGHEST_PROTOCOL)),
+                  self._timestamp(job.last_run), self._timestamp(job.next_run))
+                 for name, job in self._saved.iteritems() if job is not None]
+        deleted = [(self._key(name),) for name, job in self._saved.iteritems() if job is None]
+        runs = [(last_run, next_run, self._key(name)) for name, (last_run, next_run) in self._runs.iteritems()]
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)', saved)
+            self.connection.executemany('DELETE FROM jobs WHERE name = ?', deleted)
+            self.connection.executemany('UPDATE jobs SET last_run = ?, next_run = ? WHERE name = ?', runs)
+
+        self._saved = {}
+        self._runs = {}
+
+    def close(self):
+        """ Write the waiting changes and close the database.
+        """
+        self.flush()
+        self.connection.close()
+
+
+class SchedulerMetrics(object):
+    """ Execution statistics of a Scheduler: for each job the scheduled and actual start of its runs,
+        how long start_job took and how many runs failed or were skipped, and the depth of the dispatch queue.
+
+        Statistics are read through snapshot, and can also be written every write_interval seconds
+        to a text file in the Prometheus exposition format, for the node exporter textfile collector.
+
+    :param prometheus_path: Optional path of the Prometheus text file to write.
+    :param write_interval: The minimum number of seconds between writes of the Prometheus text file.
+    :param prefix: The prefix of the Prometheus metric names.
+    """
+
+    def __init__(self, prometheus_path=None, write_interval=15.0, prefix='scheduler'):
+        self.prometheus_path = prometheus_path
+        self.write_interval = write_interval
+        self.prefix = prefix
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_write = 0
+
+    def _job(self, name):
+        """ Return the mutable statistics of a job: [runs, failures, skipped, last_scheduled, last_started,
+            last_lateness, max_lateness, total_lateness, last_duration, max_duration, total_duration].
+        """
+        statistics = self._jobs.get(name)
+
+        if statistics is None:
+            statistics = self._jobs[name] = [0, 0, 0, None, None, None, 0.0, 0.0, None, 0.0, 0.0]
+
+        return statistics
+
+    def record_start(self, name, scheduled, started, duration, failed):
+        """ Record a run of a job.
+
+            :param name: The name of the job.
+            :param scheduled: The time the run was scheduled for.
+            :param started: The time start_job was called.
+            :param duration: The number of seconds start_job took.
+            :param failed: Whether start_job raised an exception.
+        """
+        lateness = started - scheduled
+
+        with self._lock:
+            statistics = self._job(name)
+            statistics[0] += 1
+            statistics[1] += failed
+            statistics[3:6] = scheduled, started, lateness
+            statistics[6] = max(statistics[6], lateness)
+            statistics[7] += lateness
+            statistics[8] = duration
+            statistics[9] = max(statistics[9], duration)
+            statistics[10] += duration
+
+    def record_failure(self, name):
+        """ Record a failed run of a job, reported after start_job returned.
+        """
+        with self._lock:
+            self._job(name)[1] += 1
+
+    def record_skip(self, name):
+        """ Record a run of a job skipped by its misfire policy or because it was still running.
+        """
+        with self._lock:
+            self._job(name)[2] += 1
+
+    def record_queue_depth(self, queue_depth):
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def snapshot(self):
+        """ Return the current statistics.
+
+            :return: A dictionary of the queue_depth, the max_queue_depth, and the JobStatistics of every job.
+        """
+        with self._lock:
+            jobs = dict((name, JobStatistics(statistics[0], statistics[1], statistics[2], statistics[3],
+                                             statistics[4], statistics[5], statistics[6],
+                                             statistics[7] / statistics[0] if statistics[0] else 0.0,
+                                             statistics[8], statistics[9],
+                                             statistics[10] / statistics[0] if statistics[0] else 0.0))
+                        for name, statistics in self._jobs.iteritems())
+
+        return {'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth, 'jobs': jobs}
+
+    @staticmethod
+    def _label(name):
+        return str(name).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus_text(self):
+        """ Return the current statistics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def add_metric(name, metric_type, description, samples):
+            metric = '{0}_{1}'.format(self.prefix, name)
+            lines.append('# HELP {0} {1}'.format(metric, description))
+            lines.append('# TYPE {0} {1}'.format(metric, metric_type))
+
+            for labels, value in samples:
+                lines.append('{0}{1} {2!r}'.format(metric, labels, float(value)))
+
+        add_metric('queue_depth', 'gauge', 'Runs due but not started yet.', [('', snapshot['queue_depth'])])
+        add_metric('max_queue_depth', 'gauge', 'Largest queue depth seen.', [('', snapshot['max_queue_depth'])])
+
+        jobs = sorted((self._label(name), statistics) for name, statistics in snapshot['jobs'].iteritems())
+
+        for field, name, metric_type, description in (
+                ('runs', 'job_runs_total', 'counter', 'Runs started.'),
+                ('failures', 'job_failures_total', 'counter', 'Runs that failed.'),
+                ('skipped', 'job_skipped_total', 'counter', 'Runs skipped by misfire policy or overlap.'),
+                ('last_lateness', 'job_last_lateness_seconds', 'gauge', 'Delay of the last start after its schedule.'),
+                ('max_lateness', 'job_max_lateness_seconds', 'gauge', 'Largest start delay.'),
+                ('last_duration', 'job_last_duration_seconds', 'gauge', 'Duration of the last start_job call.'),
+                ('max_duration', 'job_max_duration_seconds', 'gauge', 'Longest start_job call.')):
+            add_metric(name, metric_type, description,
+                       [('{{job="{0}"}}'.format(label), getattr(statistics, field)) for label, statistics in jobs
+                        if getattr(statistics, field) is not None])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        """ Write our Prometheus text file, atomically so a collector never reads it half written.
+        """
+        self._last_write = time_.time()
+
+        with os_util.atomic_write(self.prometheus_path, 'wb') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+
+    def maybe_write(self):
+        """ Write our Prometheus text file if we have one and write_interval has passed since the last write.
+            Errors writing it are logged, as this is called while dispatching jobs.
+        """
+        if self.prometheus_path and time_.time() - self._last_write >= self.write_interval:
+            try:
+                self.write_prometheus()
+            except (IOError, OSError):
+                logging.getLogger(__name__).exception('Failed to write {0}'.format(self.prometheus_path))
 
 
 class Scheduler(object):
     """ Manage a queue of scheduled jobs, and execute them at the proper time.
+
+        Jobs are kept in a min-heap ordered by their next run, and a single timer is armed for the earliest one,
+        so an idle scheduler does no work no matter how many jobs it holds. Replaced or removed jobs are left in
+        the heap and skipped when they reach the top.
+
+        The timer comes from a backend, QtTimerBackend, ThreadingBackend or AsyncioBackend, and start_job is
+        called from whichever thread the backend fires on.
+
+        With a JobStore, the stored jobs are loaded on startup with their next run as it was, so runs missed while
+        the process was down are caught up according to the misfire policy of each job. Adding a job with the same
+        schedule as a stored one keeps the stored runs.
+
+        Due runs can be spread out by a random jitter (per job, or for every job), and the number of jobs running
+        at once can be capped, in which case runs wait in a queue for a free slot. A job counts as running from
+        start_job until finish_job is called for it, so handlers running asynchronously must call finish_job
+        once they are done whenever max_running or prevent_overlap is used.
+
+        An exception raised by start_job is logged, and does not keep the other due jobs from starting.
+
+    :param backend: The timer backend to use, defaults to a QtTimerBackend if PyQt4 is available,
+        or a ThreadingBackend otherwise.
+    :param store: An optional JobStore to persist the jobs in.
+    :param jitter: The number of seconds every run may be delayed by at random, 0 to start runs when due.
+    :param max_running: The maximum number of jobs running at once, None for no limit.
+    :param prevent_overlap: Flag to indicate whether to skip the runs of a job that is still waiting or running.
+    :param metrics: An optional SchedulerMetrics to record execution statistics in.
     """
 
-    def __init__(self):
+    def __init__(self, backend=None, store=None, jitter=0, max_running=None, prevent_overlap=False, metrics=None):
         self.jobs = {}
-        self.schedule_checker = QTimer()
-        self.schedule_checker.setInterval(MINUTE)
+        self._heap = []
+        self._sequence = 0
+        self._lock = threading.RLock()
+        self.store = store
 
-        self._connect_slots()
+        self.jitter = jitter
+        self.max_running = max_running
+        self.prevent_overlap = prevent_overlap
+        self._track_running = max_running is not None or prevent_overlap
+        self._jittered = []
+        self._ready = deque()
+        self._waiting = set()
+        self._running = set()
+        self._queue_depth = 0
+        self._queue_depth_callbacks = []
+        self.metrics = metrics
 
-        self.schedule_checker.start()
+        if backend is None:
+            backend = QtTimerBackend() if QTimer is not None else ThreadingBackend()
 
-    def _connect_slots(self):
-        """ Connect PyQt Signals to event handler slots.
+        self.backend = backend
+        self.backend.start(self.process_jobs)
+
+        if store is not None:
+            self._load_jobs()
+
+    def _load_jobs(self):
+        """ Load every job of our store, building the heap in one go.
+        """
+        with self._lock:
+            for job in self.store.load():
+                self.jobs[job.name] = job
+                self._sequence += 1
+                self._heap.append((job.next_timestamp(), self._sequence, job))
+
+            heapq.heapify(self._heap)
+            self._arm()
+
+    def _push(self, job):
+        """ Add a job to the heap at its next run.
+        """
+        self._sequence += 1
+        heapq.heappush(self._heap, (job.next_timestamp(), self._sequence, job))
+
+    def _is_current(self, timestamp, job):
+        """ Return whether a heap entry is still the next run of a scheduled job.
+        """
+        return self.jobs.get(job.name) is job and job.next_timestamp() == timestamp
+
+    def _arm(self):
+        """ Start the timer for the earliest job in the heap or jittered run, dropping stale entries on the way.
+        """
+        while self._heap and not self._is_current(self._heap[0][0], self._heap[0][2]):
+            heapq.heappop(self._heap)
+
+        deadlines = [entries[0][0] for entries in (self._heap, self._jittered) if entries]
+
+        if self.store is not None and self.store.flush_deadline is not None:
+            deadlines.append(self.store.flush_deadline)
+
+        if not deadlines:
+            self.backend.stop()
+            return
+
+        delay = int((min(deadlines) - time_.time()) * SECOND)
+        self.backend.arm(min(max(delay, 0), MAXIMUM_SLEEP))
+
+    @property
+    def queue_depth(self):
+        """ The number of runs that are due but not started yet, waiting for their jitter or for a free slot.
+        """
+        return len(self._jittered) + len(self._ready)
+
+    @property
+    def running(self):
+        """ The names of the jobs that are running, when max_running or prevent_overlap is used.
+        """
+        return frozenset(self._running)
+
+    def add_queue_depth_callback(self, callback):
+        """ Add a function to call with the new queue depth whenever it changes.
+
+            :param callback: The function to call.
+        """
+        self._queue_depth_callbacks.append(callback)
+
+    def _notify_queue_depth(self):
+        """ Call the queue depth callbacks if the queue depth changed, must be called without holding our lock.
         """
-        self.schedule_checker.timeout.connect(self.process_jobs)
+        queue_depth = self.queue_depth
+
+        if queue_depth == self._queue_depth:
+            return
+
+        self._queue_depth = queue_depth
+
+        if self.metrics is not None:
+            self.metrics.record_queue_depth(queue_depth)
+            self.metrics.maybe_write()
+
+        for callback in self._queue_depth_callbacks:
+            callback(queue_depth)
+
+    def _queue_run(self, job, now, scheduled):
+        """ Queue a due run of a job, delaying it by its jitter.
+
+            :param scheduled: The time the run was scheduled for.
+            :return: False if the run was skipped because the job is still waiting or running.
+        """
+        if self.prevent_overlap and (job.name in self._waiting or job.name in self._running):
+            return False
+
+        jitter = job.jitter if job.jitter is not None else self.jitter
+        self._waiting.add(job.name)
+
+        if jitter:
+            self._sequence += 1
+            heapq.heappush(self._jittered, (now + random.uniform(0, jitter), self._sequence, job.name, scheduled))
+        else:
+            self._ready.append((job.name, scheduled))
+
+        return True
+
+    def _take_ready(self, now):
+        """ Move the runs whose jitter has passed to the ready queue, and take as many as there are free slots.
+
+            :return: The (job, scheduled time) of the runs to start.
+        """
+        while self._jittered and self._jittered[0][0] <= now:
+            self._ready.append(heapq.heappop(self._jittered)[2:])
+
+        runs = []
+
+        while self._ready and (self.max_running is None or len(self._running) < self.max_running):
+            name, scheduled = self._ready.popleft()
+            self._waiting.discard(name)
+            job = self.jobs.get(name)
+
+            # The job may have been removed while it was waiting.
+            if job is None:
+                continue
+
+            if self._track_running:
+                self._running.add(name)
+
+            runs.append((job, scheduled))
+
+        return runs
 
-    def add_job(self, name, data, time, day=None, frequency=None):
+    def add_job(self, name, data, time=None, day=None, frequency=None, misfire=RUN_ONCE, jitter=None):
         """ Add a new ScheduledJob to the queue.
 
             :param name: The name of the job. 
             :param data: Any data pertaining to the job.
             :param time: The time the job should execute.
             :param day: The day of the week the job should execute.
-            :param frequency: The frequency the job should execute.
+            :param frequency: The frequency the job should execute, see ScheduledJob.
+            :param misfire: What to do about missed runs, one of RUN_ONCE, RUN_ALL or SKIP.
+            :param jitter: The number of seconds each run may be delayed by at random, None to use ours.
         """
-        self.jobs[name] = ScheduledJob(name, data, time, day=day, frequency=frequency)
+        job = ScheduledJob(name, data, time, day=day, frequency=frequency, misfire=misfire, jitter=jitter)
+
+        with self._lock:
+            previous = self.jobs.get(name)
+
+            if previous is not None and previous.same_schedule(job):
+                job.last_run = previous.last_run
+                job.next_run = previous.next_run
+
+            self.jobs[name] = job
+
+            if self.store is not None:
+                self.store.save(job)
+
+            self._push(job)
+
+            if self._heap[0][2] is job or self.store is not None:
+                self._arm()
+
+    def remove_job(self, name):
+        """ Remove a job from the queue.
+
+            :param name: The name of the job to remove.
+        """
+        with self._lock:
+            if self.jobs.pop(name, None) is not None and self.store is not None:
+                self.store.delete(name)
+                self._arm()
 
     def start_job(self, name, job):
         """ Handle invoking the necessary handlers to execute a job that is ready to run.
@@ -86,23 +1069,137 @@ class Scheduler(object):
         """
         pass
 
+    def finish_job(self, name, failed=False):
+        """ Mark a running job as done, starting the runs waiting for its slot.
+
+            :param name: The name of the job that is done.
+            :param failed: Whether the job failed, for our metrics.
+        """
+        if failed and self.metrics is not None:
+            self.metrics.record_failure(name)
+
+        with self._lock:
+            self._running.discard(name)
+            runs = self._take_ready(time_.time())
+
+        self._start_jobs(runs)
+
+    def _start_jobs(self, runs):
+        """ Call start_job for each of the given (job, scheduled time) runs, recording them in our metrics.
+            A job whose start_job raises is done right away, its slot going to the next waiting run.
+        """
+        self._notify_queue_depth()
+
+        metrics = self.metrics
+        runs = deque(runs)
+
+        while runs:
+            job, scheduled = runs.popleft()
+            started = time_.time() if metrics is not None else None
+            failed = False
+
+            try:
+                self.start_job(job.name, job)
+            except Exception:
+                failed = True
+                logging.getLogger(__name__).exception('Job {0} failed to start'.format(job.name))
+
+                with self._lock:
+                    self._running.discard(job.name)
+                    runs.extend(self._take_ready(time_.time()))
+
+                self._notify_queue_depth()
+
+            if metrics is not None:
+                metrics.record_start(job.name, scheduled, started, time_.time() - started, failed)
+
+        if metrics is not None:
+            metrics.maybe_write()
+
     def process_jobs(self):
-        """ Check all the jobs in the queue for any that are ready to execute.
+        """ Queue every job whose next run has passed, schedule its following run, start the queued runs
+            there is room for, and re-arm the timer.
         """
-        for name, job in self.jobs.iteritems():
-            if job.ready():
-                self.start_job(name, job)
+        now = time_.time()
+        current_time = datetime.fromtimestamp(now)
+        misfire_time = now - float(MISFIRE_GRACE_TIME) / SECOND
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                timestamp, _, job = heapq.heappop(self._heap)
+
+                if not self._is_current(timestamp, job):
+                    continue
+
+                if job.misfire == RUN_ALL:
+                    # The following run may have passed too, it is popped again until the job has caught up.
+                    job.next_run = job.compute_next_run(job.next_run)
+                else:
+                    job.next_run = job.compute_next_run(max(job.next_run, current_time))
+
+                self._push(job)
+
+                if timestamp < misfire_time and job.misfire == SKIP:
+                    if self.store is not None:
+                        self.store.record_run(job)
+
+                    if self.metrics is not None:
+                        self.metrics.record_skip(job.name)
+
+                    continue
+
+                if not self._queue_run(job, now, timestamp):
+                    if self.metrics is not None:
+                        self.metrics.record_skip(job.name)
+
+                    continue
+
+                job.last_run = current_time
+
+                if self.store is not None:
+                    self.store.record_run(job)
+
+            if self.store is not None:
+                self.store.maybe_flush()
+
+            runs = self._take_ready(now)
+            self._arm()
+
+        if self.metrics is not None:
+            # Skipped runs are written out even when nothing is started.
+            self.metrics.maybe_write()
+
+        self._start_jobs(runs)
+
+    def close(self):
+        """ Stop the timer backend and close the job store, no job runs afterwards.
+        """
+        self.backend.close()
+
+        with self._lock:
+            if self.store is not None:
+                self.store.close()
 
 
 class UpdateScheduler(Scheduler):
     """ Manage a queue of scheduled update jobs.
 
         :param update_queue: The queue to add our jobs too.
+        :param backend: The timer backend to use (see Scheduler).
+        :param store: An optional JobStore to persist the jobs in.
+        :param jitter: The number of seconds every update may be delayed by at random.
+        :param max_running: The maximum number of updates running at once, None for no limit.
+        :param prevent_overlap: Flag to indicate whether to skip the updates of an address still being updated.
+        :param metrics: An optional SchedulerMetrics to record execution statistics in.
+
+        With max_running or prevent_overlap, finish_job must be called with the address once its update is done.
     """
 
-    def __init__(self, update_queue):
+    def __init__(self, update_queue, backend=None, store=None, jitter=0, max_running=None, prevent_overlap=False,
+                 metrics=None):
         self.update_queue = update_queue
-        super(UpdateScheduler, self).__init__()
+        super(UpdateScheduler, self).__init__(backend=backend, store=store, jitter=jitter, max_running=max_running,
+                                              prevent_overlap=prevent_overlap, metrics=metrics)
 
     def start_job(self, ip_address, job):
         """ Start a new scheduled job through the update_queue.
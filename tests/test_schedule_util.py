@@ -0,0 +1,142 @@
+# coding=utf-8
+""" Tests shared by every Scheduler backend: jobs fire on time, and an idle scheduler does not use the CPU.
+
+Run with python -m unittest discover -s tests
+
+Author: Ian Davis
+"""
+
+import resource
+import time
+import unittest
+
+from datetime import timedelta
+
+from python_utilities import schedule_util
+
+# The number of seconds a run may start after its scheduled time.
+LATENESS_TOLERANCE = 0.05
+
+# The number of CPU seconds an idle scheduler may use per second.
+IDLE_CPU_TOLERANCE = 0.02
+
+
+class RecordingScheduler(schedule_util.Scheduler):
+    """ Scheduler recording the name of every job it starts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.started = []
+        super(RecordingScheduler, self).__init__(*args, **kwargs)
+
+    def start_job(self, name, job):
+        self.started.append(name)
+        self.finish_job(name)
+
+
+class BackendTests(object):
+    """ Tests run against the backend returned by make_backend, mixed into a TestCase per backend.
+    """
+
+    def run_for(self, seconds):
+        """ Let the backend fire for the given number of seconds.
+        """
+        time.sleep(seconds)
+
+    def setUp(self):
+        self.metrics = schedule_util.SchedulerMetrics()
+        self.scheduler = RecordingScheduler(backend=self.make_backend(), metrics=self.metrics)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_firing_accuracy(self):
+        self.scheduler.add_job('interval', None, frequency=timedelta(seconds=0.1))
+        self.run_for(1.05)
+
+        statistics = self.metrics.snapshot()['jobs']['interval']
+        self.assertGreaterEqual(statistics.runs, 9)
+        self.assertLess(statistics.max_lateness, LATENESS_TOLERANCE)
+
+    def test_rearm_earlier(self):
+        self.scheduler.add_job('later', None, frequency=timedelta(hours=1))
+        self.scheduler.add_job('sooner', None, frequency=timedelta(seconds=0.1))
+        self.run_for(0.25)
+
+        self.assertIn('sooner', self.scheduler.started)
+        self.assertNotIn('later', self.scheduler.started)
+        self.assertLess(self.metrics.snapshot()['jobs']['sooner'].max_lateness, LATENESS_TOLERANCE)
+
+    def test_unwritable_metrics(self):
+        self.scheduler.close()
+        self.metrics = schedule_util.SchedulerMetrics(prometheus_path='/nonexistent/directory/scheduler.prom',
+                                                      write_interval=0)
+        self.scheduler = RecordingScheduler(backend=self.make_backend(), max_running=1, metrics=self.metrics)
+
+        self.scheduler.add_job('interval', None, frequency=timedelta(seconds=0.1))
+        self.run_for(0.55)
+
+        self.assertGreaterEqual(len(self.scheduler.started), 4)
+        self.assertEqual(self.scheduler.running, frozenset())
+
+    def test_idle_cpu(self):
+        self.scheduler.add_job('idle', None, frequency=timedelta(hours=1))
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        self.run_for(1.0)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+        used = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        self.assertLess(used, IDLE_CPU_TOLERANCE)
+        self.assertEqual(self.scheduler.started, [])
+
+
+class ThreadingBackendTest(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        return schedule_util.ThreadingBackend()
+
+    def test_callback_error(self):
+        calls = []
+
+        def callback():
+            calls.append(time.time())
+
+            if len(calls) == 1:
+                raise RuntimeError('Failed on purpose')
+
+        backend = schedule_util.ThreadingBackend()
+        backend.start(callback)
+
+        try:
+            backend.arm(10)
+            self.run_for(0.1)
+            backend.arm(10)
+            self.run_for(0.1)
+        finally:
+            backend.close()
+
+        self.assertEqual(len(calls), 2)
+
+
+@unittest.skipIf(schedule_util.asyncio is None, 'Python module asyncio (or trollius) is not available')
+class AsyncioBackendTest(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        # The same loop is kept when a test replaces its scheduler.
+        if getattr(self, 'loop', None) is None:
+            self.loop = schedule_util.asyncio.new_event_loop()
+
+        return schedule_util.AsyncioBackend(self.loop)
+
+    def run_for(self, seconds):
+        self.loop.call_later(seconds, self.loop.stop)
+        self.loop.run_forever()
+
+    def tearDown(self):
+        super(AsyncioBackendTest, self).tearDown()
+        self.loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()